@@ -0,0 +1,416 @@
+"""Offline benchmark / load test of m4.py: no Discord, no YouTube.
+
+The real command callbacks (play, playlist, seek, bass) and track transitions run against
+fake voice clients that pull 20 ms frames like discord.py's AudioPlayer, a stub extractor in
+place of fetch_info / fetch_playlist_entries, and a WAV file served over loopback HTTP
+(so ffmpeg, the jitter buffer, fan-out and admission work as in production).
+
+    python bench.py --guilds 50 --tracks 3 --track-seconds 20
+
+Report: stdout + bench_output.txt. Needs ffmpeg on PATH like the bot itself.
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import http.server
+import math
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+WORKDIR = tempfile.mkdtemp(prefix="m4bench-")
+# never touch the bot's real state / history / cache
+os.environ["STATE_DB"] = ""
+os.environ["HISTORY_DIR"] = os.path.join(WORKDIR, "history")
+os.environ.setdefault("AUDIO_CACHE_DIR", os.path.join(WORKDIR, "audio_cache"))
+os.environ.setdefault("AUDIO_CACHE_MB", "0")
+os.environ.setdefault("METRICS_PORT", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import discord
+import m4
+
+# -----------------------
+# Loopback audio + stub extractor
+# -----------------------
+def write_tone(path, seconds):
+    # 48 kHz stereo s16 sine, what ffmpeg decodes for every bench track
+    frame = b"".join(struct.pack("<hh", v, v) for v in
+                     (int(8000 * math.sin(2 * math.pi * 440 * i / 48000)) for i in range(480)))
+    with wave.open(path, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes(frame * int(seconds * 100))
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve_audio(directory):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class StubExtractor:
+    """fetch_info / fetch_playlist_entries / search_entries over bench://<guild>/<n> pseudo urls."""
+    def __init__(self, base_url, seconds, delay, shared):
+        self.base_url = base_url
+        self.seconds = seconds
+        self.delay = delay    # simulated yt-dlp latency per call
+        self.shared = shared  # same track ids in every guild -> fan-out
+        self.calls = collections.Counter()
+
+    def track(self, guild, n, resolved=True):
+        vid = f"bench{n:06d}" if self.shared else f"b{guild:04d}t{n:05d}"
+        return m4.Track(vid, f"Bench {guild}/{n}", f"bench://{guild}/{n}", None, self.seconds, "pcm_s16le",
+                        f"{self.base_url}/tone.wav?v={vid}" if resolved else None,
+                        time.time() + 86400 if resolved else 0)
+
+    def fetch_info(self, query):
+        self.calls["fetch_info"] += 1
+        time.sleep(self.delay)
+        guild, n = query[len("bench://"):].split("/")
+        return self.track(int(guild), int(n))
+
+    def fetch_playlist_entries(self, url, push, cancel):
+        self.calls["fetch_playlist_entries"] += 1
+        guild, count = url[len("bench-playlist://"):].split("/")
+        try:
+            for n in range(1000, 1000 + int(count)):
+                if cancel.is_set():
+                    break
+                time.sleep(self.delay / 10)
+                push(self.track(int(guild), n, resolved=False))  # flat entries, resolved when played
+        finally:
+            push(None)
+
+    def search_entries(self, query, count=5):
+        self.calls["search_entries"] += 1
+        time.sleep(self.delay)
+        return []
+
+    def install(self):
+        m4.fetch_info = self.fetch_info
+        m4.fetch_playlist_entries = self.fetch_playlist_entries
+        m4.search_entries = self.search_entries
+
+# -----------------------
+# Fake Discord objects
+# -----------------------
+class GuildStats:
+    def __init__(self):
+        self.frames = 0          # frames pulled by the voice thread (incl. silence)
+        self.late = 0            # frames sent more than one frame period behind schedule
+        self.reads = []          # source.read() durations
+        self.gaps = []           # natural end of a track -> first decoded frame of the next one
+        self.gap_since = None
+        self.errors = []
+
+class FakeVoice:
+    """discord.VoiceClient stand-in: a thread per play() pulls a frame every 20 ms like AudioPlayer."""
+    encode = False
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.paused = False
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.source is not None and self.paused
+
+    def play(self, source, after=None):
+        if self.source is not None:
+            raise discord.ClientException("Already playing audio.")
+        self.source = source
+        self.paused = False
+        threading.Thread(target=self._run, args=(source, after), daemon=True).start()
+
+    def stop(self):
+        self.source = None
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.guild.voice_client = None
+
+    def _run(self, source, after):
+        stats = self.guild.stats
+        encoder = discord.opus.Encoder() if self.encode and not source.is_opus() else None
+        decoder = m4.decoder_of(source)
+        started = time.perf_counter()
+        loops = 0
+        error = None
+        try:
+            while self.source is source:
+                if self.paused:
+                    time.sleep(m4.FRAME_SECONDS)
+                    started, loops = time.perf_counter(), 0
+                    continue
+                t = time.perf_counter()
+                data = source.read()
+                stats.reads.append(time.perf_counter() - t)
+                if not data:
+                    stats.gap_since = time.perf_counter()
+                    break
+                if stats.gap_since is not None and decoder is not None and decoder.index:
+                    stats.gaps.append(time.perf_counter() - stats.gap_since)
+                    stats.gap_since = None
+                if encoder:
+                    encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                stats.frames += 1
+                loops += 1
+                delay = started + loops * m4.FRAME_SECONDS - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -m4.FRAME_SECONDS:
+                    stats.late += 1
+        except Exception as e:
+            error = e
+            stats.errors.append(repr(e))
+        finally:
+            if self.source is source:
+                self.source = None
+            source.cleanup()
+            if after:
+                after(error)
+
+class FakeMessage:
+    _ids = iter(range(1, 1 << 62))
+
+    def __init__(self, channel):
+        self.id = next(self._ids)
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+class FakeChannel:
+    def __init__(self, cid, guild=None):
+        self.id = cid
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+    async def connect(self, **kwargs):
+        self.guild.voice_client = FakeVoice(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, gid):
+        self.id = gid
+        self.voice_client = None
+        self.stats = GuildStats()
+
+class FakeCtx:
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = FakeChannel(guild.id * 10)
+        voice = FakeChannel(guild.id * 10 + 1, guild)
+        self.author = type("Author", (), {"voice": type("VoiceState", (), {"channel": voice})()})()
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+# -----------------------
+# Scenario
+# -----------------------
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def rss_bytes(pid="self"):
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def child_pids():
+    me = os.getpid()
+    pids = []
+    for name in os.listdir("/proc") if os.path.isdir("/proc") else ():
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == me:
+                        pids.append(name)
+            except (OSError, ValueError, IndexError):
+                pass
+    return pids
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.latency = collections.defaultdict(list)  # command -> seconds
+        self.failures = collections.Counter()
+        self.guilds = []
+        self.peak_rss = 0
+        self.peak_children_rss = 0
+
+    async def command(self, name, coro):
+        started = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            self.failures[f"{name}: {type(e).__name__}"] += 1
+        self.latency[name].append(time.perf_counter() - started)
+
+    async def guild(self, index):
+        a = self.args
+        guild = FakeGuild(index + 1)
+        self.guilds.append(guild)
+        ctx = FakeCtx(guild)
+        await asyncio.sleep(a.ramp * index / max(1, a.guilds))
+        for n in range(a.tracks):
+            await self.command("play", m4.play.callback(ctx, query=f"bench://{guild.id}/{n}"))
+        if a.playlist:
+            await self.command("playlist", m4.playlist.callback(ctx, f"bench-playlist://{guild.id}/{a.playlist}"))
+        await asyncio.sleep(a.track_seconds * 0.3)
+        await self.command("seek", m4.seek.callback(ctx, str(int(a.track_seconds * 0.6))))
+        await asyncio.sleep(1.0)
+        await self.command("bass", m4.bass.callback(ctx, 6))
+        deadline = time.monotonic() + (a.tracks + a.playlist) * a.track_seconds * 3 + 60
+        player = m4.players.get(guild.id)
+        while player and time.monotonic() < deadline:
+            job = player.playlist_job
+            if player.state == "idle" and not player.queue and not (job and not job["task"].done()):
+                break
+            await asyncio.sleep(0.25)
+        else:
+            if player:
+                self.failures["timeout waiting for the queue to drain"] += 1
+        m4.release_player(guild.id)
+        if guild.voice_client:
+            await guild.voice_client.disconnect()
+
+    async def sample_memory(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, rss_bytes())
+            self.peak_children_rss = max(self.peak_children_rss, sum(rss_bytes(p) for p in child_pids()))
+            await asyncio.sleep(0.5)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        m4.bot.loop = loop  # post_event() hops from the voice threads onto this loop
+        base_rss = rss_bytes()
+        cpu0, children0, wall0 = time.process_time(), os.times(), time.perf_counter()
+        sampler = loop.create_task(self.sample_memory())
+        lag = loop.create_task(m4.watch_loop_lag())
+        await asyncio.gather(*(self.guild(i) for i in range(self.args.guilds)))
+        await asyncio.sleep(1.0)  # let the last decoders exit so their CPU time is accounted
+        sampler.cancel()
+        lag.cancel()
+        children1 = os.times()
+        return {
+            "wall": time.perf_counter() - wall0,
+            "cpu": time.process_time() - cpu0,
+            "children_cpu": (children1.children_user + children1.children_system
+                             - children0.children_user - children0.children_system),
+            "base_rss": base_rss,
+        }
+
+    def report(self, totals, extractor):
+        a = self.args
+        ms = lambda v: f"{v * 1000:.1f}"
+        gaps = [g for guild in self.guilds for g in guild.stats.gaps]
+        reads = [r for guild in self.guilds for r in guild.stats.reads]
+        frames = sum(guild.stats.frames for guild in self.guilds)
+        late = sum(guild.stats.late for guild in self.guilds)
+        stream_seconds = frames * m4.FRAME_SECONDS or 1.0
+        mb = 1024 * 1024
+        lines = [
+            f"m4 bench: {a.guilds} serwerów, {a.tracks} utworów po {a.track_seconds}s"
+            f"{f' + playlista {a.playlist}' if a.playlist else ''}, opóźnienie ekstrakcji {a.extract_delay}s, "
+            f"wspólne utwory {'tak' if a.shared else 'nie'}, kodowanie Opus {'tak' if FakeVoice.encode else 'nie'}",
+            f"czas {totals['wall']:.1f}s, strumienie {stream_seconds:.0f}s audio",
+            "",
+            "Przerwy między utworami (ms): "
+            f"n={len(gaps)} p50={ms(percentile(gaps, 0.5))} p95={ms(percentile(gaps, 0.95))} "
+            f"max={ms(max(gaps, default=0))}",
+            "Opóźnienie komend (ms):",
+        ]
+        for name in ("play", "playlist", "seek", "bass"):
+            v = self.latency.get(name)
+            if v:
+                lines.append(f"  {name:<9} n={len(v)} p50={ms(percentile(v, 0.5))} p95={ms(percentile(v, 0.95))} "
+                             f"max={ms(max(v))}")
+        lines += [
+            f"Ramki: {frames}, spóźnione {late}, read() p99={ms(percentile(reads, 0.99))} ms "
+            f"max={ms(max(reads, default=0))} ms, niedobory {m4.jitter_stats['underruns']}",
+            f"CPU bota: {totals['cpu']:.2f}s ({100 * totals['cpu'] / stream_seconds:.2f}% rdzenia na strumień), "
+            f"ffmpeg: {totals['children_cpu']:.2f}s ({100 * totals['children_cpu'] / stream_seconds:.2f}% na strumień)",
+            f"Pamięć bota: start {totals['base_rss'] / mb:.1f} MB, szczyt {self.peak_rss / mb:.1f} MB, "
+            f"{(self.peak_rss - totals['base_rss']) / mb / max(1, a.guilds):.2f} MB na serwer; "
+            f"ffmpeg szczyt {self.peak_children_rss / mb:.1f} MB",
+            f"Wywołania ekstraktora: {dict(extractor.calls)}",
+        ]
+        if self.failures:
+            lines.append(f"Błędy: {dict(self.failures)}")
+        errors = [e for guild in self.guilds for e in guild.stats.errors]
+        if errors:
+            lines.append(f"Błędy odtwarzania: {len(errors)} (np. {errors[0]})")
+        if a.metrics:
+            lines += ["", m4.metrics.render()]
+        return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the m4 music bot")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=3, help="tracks queued with !play per guild")
+    parser.add_argument("--track-seconds", type=float, default=10.0)
+    parser.add_argument("--playlist", type=int, default=0, help="entries of an extra !playlist per guild")
+    parser.add_argument("--extract-delay", type=float, default=0.3, help="simulated yt-dlp latency (s)")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which the guilds start")
+    parser.add_argument("--shared", action="store_true", help="all guilds play the same track ids")
+    parser.add_argument("--encode", action="store_true", help="Opus-encode PCM frames like the voice client")
+    parser.add_argument("--metrics", action="store_true", help="append m4's Prometheus metrics")
+    parser.add_argument("--output", default="bench_output.txt")
+    args = parser.parse_args()
+
+    if args.encode and not discord.opus.is_loaded() and not discord.opus._load_default():
+        sys.exit("--encode: libopus nie jest dostępny")
+    FakeVoice.encode = args.encode
+    write_tone(os.path.join(WORKDIR, "tone.wav"), args.track_seconds)
+    server = serve_audio(WORKDIR)
+    extractor = StubExtractor(f"http://127.0.0.1:{server.server_address[1]}",
+                              args.track_seconds, args.extract_delay, args.shared)
+    extractor.install()
+
+    bench = Bench(args)
+    totals = asyncio.run(bench.run())
+    text = bench.report(totals, extractor)
+    server.shutdown()
+    print(text)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,34 @@
-# m.py - Music Bot v3.1 PCM (Simple) - filters ON/OFF, no embed on filter/volume
-# Requirements: pip install -U discord.py yt-dlp PyNaCl
+# m.py - Music Bot v3.2 - Opus passthrough, in-process filters, live now-playing panel
+# Requirements: pip install -r requirements.txt (discord.py PyNaCl yt-dlp numpy scipy;
+#   without numpy/scipy filters fall back to ffmpeg -af restarts)
 # FFmpeg in PATH
 # Put your token at the bottom
 
 import discord
 from discord.ext import commands
 import yt_dlp as youtube_dl
+try:
+    import numpy as np
+    from scipy.signal import sosfilt
+except ImportError:  # no in-process DSP -> filters fall back to ffmpeg -af restarts
+    np = None
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import functools
+import io
+import itertools
+import json
+import multiprocessing
+import os
 import random
+import re
+import sqlite3
+import signal
+import subprocess
+import sys
+import threading
 import time
 
 intents = discord.Intents.default()
@@ -15,22 +36,228 @@ intents.message_content = True
 intents.guilds = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+# sharding: SHARD_COUNT/SHARD_IDS pin this process to some shards (set by the launcher, see main());
+# unset -> AutoShardedBot picks Discord's recommended count and runs all of them here
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()] or None
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+
+class MusicBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        await start_metrics()
+        start_panels(self)
+        self.loop.create_task(release_idle_players())
+        try:
+            # platforms / launchers stop the bot with SIGTERM: close() still writes the final snapshot
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows / not the main thread
+
+    async def close(self):
+        # final snapshot before the voice clients go away (their disconnects must not wipe the saved state)
+        state_store.closing = True
+        try:
+            await flush_state(everything=True)
+        except Exception as e:
+            report_error("final_flush", e)
+        await super().close()
+
+bot = MusicBot(command_prefix="!", intents=intents, help_command=None, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+def owns_guild(gid):
+    """Is `gid` served by one of this process's shards? (guild state is process-local)"""
+    if not bot.shard_ids or not bot.shard_count:
+        return True
+    return (gid >> 22) % bot.shard_count in bot.shard_ids
+
+# -----------------------
+# State: one GuildPlayer per active guild, dropped on disconnect / guild removal
+# -----------------------
+HISTORY_SIZE = 100  # play events kept in memory per guild (older ones only in the on-disk log)
+
+class Track:
+    """Queue entry. url/expires are filled lazily (ensure_stream)."""
+    __slots__ = ("id", "title", "webpage", "thumb", "duration", "acodec", "url", "expires")
+
+    def __init__(self, id=None, title="Unknown", webpage=None, thumb=None, duration=None,
+                 acodec=None, url=None, expires=0):
+        self.id = id
+        self.title = title
+        self.webpage = webpage
+        self.thumb = thumb
+        self.duration = duration
+        self.acodec = acodec
+        self.url = url
+        self.expires = expires
+
+    def copy(self):
+        return Track(self.id, self.title, self.webpage, self.thumb, self.duration,
+                     self.acodec, self.url, self.expires)
+
+class GuildPlayer:
+    __slots__ = ("guild", "channel", "queue", "history", "filter", "bass", "volume", "current",
+                 "start_time", "start_offset", "loop_mode", "autoplay",
+                 "last_used", "control_message", "prefetch", "prefetch_task", "playlist_job",
+                 "history_loaded", "control_task", "control_changed",
+                 "state", "generation", "events", "event_task", "autoplay_next", "autoplay_task",
+                 "recoveries", "panel_shown", "panel_due")
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = None             # text channel of the last command (announcements go there)
+        self.queue = collections.deque()
+        self.history = collections.deque(maxlen=HISTORY_SIZE)  # PlayEvent, oldest first
+        self.history_loaded = False     # tail of the on-disk log merged into history yet?
+        self.control_task = None        # pending coalesced restart for volume/bass/filter changes
+        self.control_changed = 0.0      # loop time of the newest such change
+        self.filter = None              # 'nightcore' | 'vaporwave' | 'eq:<preset>' | None
+        self.bass = 0                   # dB
+        self.volume = 1.0               # 1.0 == 100%
+        self.current = None             # Track playing now
+        self.start_time = None
+        self.start_offset = 0.0
+        self.state = "idle"             # 'idle' | 'playing' (paused counts as playing)
+        self.generation = 0             # bumped on every voice.play() and every deliberate stop
+        self.recoveries = 0             # mid-stream recoveries of the current track
+        self.events = None              # asyncio.Queue of transition events, see post_event
+        self.event_task = None          # consumer of events
+        self.loop_mode = 0              # 0 none,1 single,2 queue
+        self.autoplay = False
+        self.autoplay_next = None       # (based on Track, picked Track) chosen while the base played
+        self.autoplay_task = None       # (base Track, asyncio.Task) picking it
+        self.last_used = 0.0            # loop time of the last command / button touching the player
+        self.control_message = None     # discord.Message of the live now-playing panel
+        self.panel_shown = None         # embed dict the panel shows now
+        self.panel_due = 0.0            # loop time of the next progress refresh
+        self.prefetch = None            # {"track","key","source"} warm source for the next track
+        self.prefetch_task = None       # asyncio.Task waiting to warm the next track
+        self.playlist_job = None        # {"cancel": threading.Event, "task": asyncio.Task, "added": int}
+
+players = {}  # guild id -> GuildPlayer
+
+def get_player(guild):
+    player = players.get(guild.id)
+    if player is None:
+        player = players[guild.id] = GuildPlayer(guild)
+    player.last_used = now_time()
+    return player
+
+def player_for(ctx):
+    player = get_player(ctx.guild)
+    player.channel = ctx.channel
+    return player
+
+def release_player(gid):
+    """Free everything a guild holds: playlist job, warm decoder, queue."""
+    player = players.pop(gid, None)
+    if player is None:
+        return
+    state_store.forget(gid)
+    cancel_ingest(player)
+    drop_prefetch(player)
+    if player.control_task:
+        player.control_task.cancel()
+    if player.event_task:
+        player.event_task.cancel()
+    if player.autoplay_task:
+        player.autoplay_task[1].cancel()
+    player.autoplay_next = player.autoplay_task = None
+    player.generation += 1  # the after callback of whatever still plays is now stale
+    player.queue.clear()
+    player.current = None
+
+PLAYER_IDLE_TIMEOUT = 600.0  # seconds; a player created outside voice (settings, buttons) is dropped after this
+
+async def release_idle_players():
+    """A voice disconnect releases a player; this catches the ones that never had a voice connection."""
+    while True:
+        await asyncio.sleep(PLAYER_IDLE_TIMEOUT / 10)
+        now = now_time()
+        for gid, player in list(players.items()):
+            if player.guild.voice_client is None and now - player.last_used > PLAYER_IDLE_TIMEOUT:
+                release_player(gid)
 
 # -----------------------
-# State
+# Metrics: counters + latency histograms as Prometheus text (METRICS_PORT on METRICS_HOST, !metrics).
+# The 20 ms audio path only bumps plain ints (jitter_stats, ...), collectors read them at render time
 # -----------------------
-queues = {}
-history = {}
-filters = {}        # main filter per guild: 'nightcore' | 'vaporwave' | 'eq:<preset>' | None
-bass_gain = {}      # guild -> dB (int)
-volumes = {}        # guild -> float (1.0 == 100%)
-current_song = {}   # guild -> {url,title,webpage,thumb,duration,start_time,start_offset}
-suppress_after = {} # guild -> bool
-loop_mode = {}      # 0 none,1 single,2 queue
-autoplay = {}
-search_results = {}
-control_message = {}
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0: no HTTP endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last one: above the largest bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _labels(labels):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()  # observed from extraction / reader threads too
+        self.counters = collections.defaultdict(int)  # (name, labels) -> n
+        self.histograms = {}                          # (name, labels) -> Histogram
+        self.collectors = []  # fn() -> [(name, "counter" | "gauge", labels, value)], called by render()
+
+    def inc(self, name, n=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def sample(name, kind, labels, value):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            hists = sorted((key, list(h.counts), h.sum, h.count) for key, h in self.histograms.items())
+        for (name, labels), value in counters:
+            sample(name, "counter", labels, value)
+        for (name, labels), counts, total, count in hists:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for le, n in zip(LATENCY_BUCKETS + ("+Inf",), itertools.accumulate(counts)):
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {n}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for fn in self.collectors:
+            for name, kind, labels, value in fn():
+                sample(name, kind, tuple(sorted(labels.items())), value)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def report_error(where, exc):
+    """A failure the caller handles (falls back / gives up): counted and logged instead of swallowed."""
+    metrics.inc("m4_errors_total", where=where)
+    print(f"[{where}] {type(exc).__name__}: {exc}")
 
 # -----------------------
 # yt-dlp + ffmpeg base
@@ -47,7 +274,8 @@ ydl_opts = {
 
 
 
-FFMPEG_RECONNECT = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+# -rw_timeout: a stalled connection ends ffmpeg (-> mid-stream recovery) instead of blocking the voice thread
+FFMPEG_RECONNECT = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -rw_timeout 15000000"
 FFMPEG_BASE = "-vn"
 
 EQ_PRESETS = {
@@ -61,20 +289,97 @@ EQ_PRESETS = {
 # -----------------------
 # Helpers
 # -----------------------
-def get_queue(gid):
-    return queues.setdefault(gid, [])
-
-def get_history(gid):
-    return history.setdefault(gid, [])
-
 def now_time():
     return asyncio.get_event_loop().time()
 
+STREAM_URL_TTL = 1800     # fallback lifetime when a stream url carries no expire= param
+STREAM_URL_MARGIN = 300   # refresh urls that expire sooner than this
+
+def stream_expiry(url):
+    m = re.search(r"[?&/]expire[=/](\d+)", url or "")
+    if m:
+        return int(m.group(1))
+    return time.time() + STREAM_URL_TTL
+
+def pick_stream_url(info):
+    if info.get("url"):
+        return info["url"]
+    for f in info.get("formats") or []:
+        if f.get("url"):
+            return f["url"]
+    return None
+
+def track_from_info(info):
+    stream_url = pick_stream_url(info)
+    return Track(
+        id=info.get("id"),
+        title=info.get("title", "Unknown"),
+        webpage=info.get("webpage_url", None),
+        thumb=info.get("thumbnail", None),
+        duration=info.get("duration", None),
+        acodec=info.get("acodec", None),
+        url=stream_url,
+        expires=stream_expiry(stream_url) if stream_url else 0
+    )
+
+def track_from_entry(entry):
+    """Flat playlist entry -> metadata-only track (entry["url"] is the watch page here, not a stream)."""
+    vid = entry.get("id")
+    webpage = entry.get("webpage_url") or entry.get("url")
+    if (not webpage or not webpage.startswith("http")) and vid:
+        webpage = f"https://www.youtube.com/watch?v={vid}"
+    thumb = entry.get("thumbnail")
+    if not thumb and entry.get("thumbnails"):
+        thumb = entry["thumbnails"][-1].get("url")
+    return Track(
+        id=vid,
+        title=entry.get("title", "Unknown"),
+        webpage=webpage,
+        thumb=thumb,
+        duration=entry.get("duration", None)
+    )
+
+# -----------------------
+# Long-lived YoutubeDL instances: one per worker thread and option set, cookies parsed once
+# -----------------------
+_ydl_local = threading.local()
+COOKIE_SAVE_EVERY = 600.0  # seconds between writes of an instance's (rotated) cookie jar to cookies.txt
+
+def _cookie_mtime():
+    try:
+        return os.path.getmtime(ydl_opts["cookiefile"])
+    except OSError:
+        return None
+
+def get_ydl(**overrides):
+    """YoutubeDL for the calling worker thread. Rebuilt only when cookies.txt changes on disk.
+    Never closed (close() writes the cookie jar on every call); instead the jar is saved every
+    COOKIE_SAVE_EVERY seconds so rotated cookies survive restarts, and our own write is not a change."""
+    instances = getattr(_ydl_local, "instances", None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+    key = tuple(sorted(overrides.items()))
+    mtime = _cookie_mtime()
+    entry = instances.get(key)
+    if entry is None or entry[1] != mtime:
+        ydl = youtube_dl.YoutubeDL({**ydl_opts, **overrides})
+        ydl.cookiejar  # load cookies.txt now instead of on the first request
+        entry = instances[key] = [ydl, mtime, time.monotonic()]
+    elif mtime is not None and time.monotonic() - entry[2] >= COOKIE_SAVE_EVERY:
+        # saved here, on the thread that owns the jar, so no extraction is touching it meanwhile
+        entry[2] = time.monotonic()
+        try:
+            entry[0].cookiejar.save()
+            entry[1] = _cookie_mtime()
+        except Exception as e:
+            report_error("cookie_save", e)
+    return entry[0]
+
 def fetch_info(query_or_url):
     try:
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(query_or_url, download=False)
-    except Exception:
+        info = get_ydl().extract_info(query_or_url, download=False)
+    except Exception as e:
+        report_error("fetch_info", e)
         return None
     if not info:
         return None
@@ -82,55 +387,351 @@ def fetch_info(query_or_url):
         if not info["entries"]:
             return None
         info = info["entries"][0]
-    stream_url = None
-    if info.get("url"):
-        stream_url = info["url"]
-    elif info.get("formats"):
-        for f in info["formats"]:
-            if f.get("url"):
-                stream_url = f["url"]; break
-    title = info.get("title", "Unknown")
-    webpage = info.get("webpage_url", None)
-    thumb = info.get("thumbnail", None)
-    duration = info.get("duration", None)
-    return stream_url, title, webpage, thumb, duration
-
-def fetch_playlist_entries(playlist_url):
-    entries = []
+    return track_from_info(info)
+
+def fetch_playlist_entries(playlist_url, push, cancel):
+    """Blocking: pages through the playlist (flat) and push()es each track as soon as yt-dlp yields it.
+    Stops early once the `cancel` event is set. push(None) always marks the end."""
     try:
-        with youtube_dl.YoutubeDL({**ydl_opts, "noplaylist": False}) as ydl:
-            info = ydl.extract_info(playlist_url, download=False)
-    except Exception:
-        return entries
-    if not info:
-        return entries
-    if "entries" in info:
-        for it in info["entries"]:
-            if not it: continue
-            stream_url = it.get("url")
-            if not stream_url and it.get("formats"):
-                for f in it["formats"]:
-                    if f.get("url"):
-                        stream_url = f["url"]; break
-            title = it.get("title", "Unknown")
-            webpage = it.get("webpage_url", None)
-            thumb = it.get("thumbnail", None)
-            duration = it.get("duration", None)
-            if stream_url:
-                entries.append((stream_url, title, webpage, thumb, duration))
-    return entries
-
-# -----------------------
-# Build filter string (volume, bass, main filter)
-# -----------------------
-def build_filter_string(gid):
+        # socket_timeout: a stalled page fails instead of holding the worker (and the bulk slot) forever
+        ydl = get_ydl(noplaylist=False, extract_flat="in_playlist", socket_timeout=EXTRACT_TIMEOUT)
+        info = ydl.extract_info(playlist_url, download=False, process=False)
+        # watch?v=..&list=.. and similar urls redirect to the playlist extractor
+        for _ in range(3):
+            if not info or info.get("_type") not in ("url", "url_transparent"):
+                break
+            info = ydl.extract_info(info["url"], download=False, process=False)
+        if info and "entries" in info:
+            for it in info["entries"]:
+                if cancel.is_set():
+                    break
+                if not it: continue
+                track = track_from_entry(it)
+                if track.webpage:
+                    push(track)
+    except Exception as e:
+        report_error("fetch_playlist", e)
+    finally:
+        push(None)
+
+def search_entries(query, count=5):
+    try:
+        data = get_ydl().extract_info(f"ytsearch{count}:{query}", download=False)
+    except Exception as e:
+        report_error("search", e)
+        return []
+    if not data or "entries" not in data:
+        return []
+    return [track_from_info(e) for e in data["entries"] if e]
+
+# -----------------------
+# Extraction service (yt-dlp runs in worker threads, never on the event loop)
+# -----------------------
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "30"))
+
+extract_pool = concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="ytdl",
+                                                     initializer=get_ydl)
+
+# -----------------------
+# Admission control: global + per-guild caps on ffmpeg decoders and yt-dlp jobs. Waiters are served by
+# priority, round-robin across guilds within a priority; a full queue or a too long wait -> Saturated
+# -----------------------
+PRIO_PLAYBACK, PRIO_INTERACTIVE, PRIO_BULK = 0, 1, 2  # next track / user commands, prefetch + search, playlists
+ADMISSION_WAIT = {PRIO_PLAYBACK: 30.0, PRIO_INTERACTIVE: 15.0, PRIO_BULK: 120.0}
+MAX_DECODERS = int(os.getenv("MAX_DECODERS", "128"))       # ffmpeg processes in this bot process
+GUILD_DECODERS = int(os.getenv("GUILD_DECODERS", "3"))     # current + prefetched + one restart overlap
+GUILD_EXTRACTIONS = int(os.getenv("GUILD_EXTRACTIONS", "2"))
+
+class Saturated(Exception):
+    """The job was not admitted (too many waiting or waited too long)."""
+
+class Slot:
+    __slots__ = ("owner", "gid", "released")
+
+    def __init__(self, owner, gid):
+        self.owner = owner
+        self.gid = gid
+        self.released = False
+
+    def disown(self):
+        """Stop charging the slot to its guild (decoder shared by several guilds); still counts globally."""
+        if self.released or self.gid is None:
+            return
+        gid, self.gid = self.gid, None
+        self.owner._call(self.owner._disown, gid)
+
+    def release(self):
+        """Idempotent, callable from any thread."""
+        if self.released:
+            return
+        self.released = True
+        self.owner._call(self.owner._release, self.gid)
+
+class Admission:
+    def __init__(self, name, limit, per_guild, reserve=0, max_waiting=500, per_guild_waiting=20):
+        self.name = name
+        self.limit = limit
+        self.per_guild = per_guild
+        self.reserve = reserve  # slots only PRIO_PLAYBACK may take
+        self.max_waiting = max_waiting
+        self.per_guild_waiting = per_guild_waiting
+        self.in_use = 0
+        self.by_guild = collections.Counter()
+        self.waiting = [collections.OrderedDict() for _ in ADMISSION_WAIT]  # priority -> guild -> deque of futures
+        self.n_waiting = 0
+        self.loop = None
+        self.stats = {"granted": 0, "queued": 0, "rejected": 0}
+
+    def _call(self, fn, *args):
+        # counters live on the event loop; voice / worker threads hop over
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self.loop is None or running is self.loop:
+            fn(*args)
+        else:
+            try:
+                self.loop.call_soon_threadsafe(fn, *args)
+            except RuntimeError:
+                pass  # loop closed, shutting down
+
+    def _cap(self, priority):
+        return self.limit - (self.reserve if priority > PRIO_PLAYBACK else 0)
+
+    def _count(self, gid, n):
+        self.in_use += n
+        if gid is not None:
+            self.by_guild[gid] += n
+            if self.by_guild[gid] <= 0:
+                del self.by_guild[gid]
+
+    def _grant(self, gid):
+        self._count(gid, 1)
+        self.stats["granted"] += 1
+        return Slot(self, gid)
+
+    def _release(self, gid):
+        self._count(gid, -1)
+        self._dispatch()
+
+    def _disown(self, gid):
+        self._count(gid, -1)
+        self._count(None, 1)
+        self._dispatch()
+
+    def _dispatch(self):
+        for priority, queues in enumerate(self.waiting):
+            progressed = True
+            while progressed and queues:
+                progressed = False
+                for gid in list(queues):
+                    if self.in_use >= self._cap(priority):
+                        return  # lower priorities have the same or a smaller cap
+                    if gid is not None and self.by_guild[gid] >= self.per_guild:
+                        continue
+                    queue = queues.pop(gid)  # re-inserted at the end -> round-robin between guilds
+                    fut = queue.popleft()
+                    self.n_waiting -= 1
+                    if queue:
+                        queues[gid] = queue
+                    progressed = True
+                    if not fut.done():
+                        fut.set_result(self._grant(gid))
+
+    async def acquire(self, gid=None, priority=PRIO_INTERACTIVE):
+        self.loop = asyncio.get_running_loop()
+        if not self.n_waiting and self.in_use < self._cap(priority) and \
+                (gid is None or self.by_guild[gid] < self.per_guild):
+            return self._grant(gid)
+        queues = self.waiting[priority]
+        queue = queues.get(gid)
+        if self.n_waiting >= self.max_waiting or (queue and len(queue) >= self.per_guild_waiting):
+            self.stats["rejected"] += 1
+            raise Saturated(self.name)
+        if queue is None:
+            queue = queues[gid] = collections.deque()
+        fut = self.loop.create_future()
+        queue.append(fut)
+        self.n_waiting += 1
+        self.stats["queued"] += 1
+        # others waiting may be blocked only by their own guild cap -> this one can still be granted now
+        self._dispatch()
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), ADMISSION_WAIT[priority])
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                fut.result().release()  # granted while we were giving up
+            else:
+                fut.cancel()
+                if fut in queue:
+                    queue.remove(fut)
+                    self.n_waiting -= 1
+                    if not queue and queues.get(gid) is queue:
+                        del queues[gid]
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["rejected"] += 1
+                raise Saturated(self.name) from None
+            raise
+
+    def take(self, gid=None):
+        """Count a decoder opened where waiting is impossible (voice thread fallback); never blocks."""
+        self._call(self._count, gid, 1)
+        return Slot(self, gid)
+
+decoder_slots = Admission("dekodery", MAX_DECODERS, GUILD_DECODERS, reserve=max(1, MAX_DECODERS // 10))
+extract_slots = Admission("ekstrakcje", EXTRACT_WORKERS, GUILD_EXTRACTIONS, reserve=1 if EXTRACT_WORKERS > 1 else 0)
+
+SATURATED_MSG = "⏳ Bot jest teraz przeciążony — spróbuj ponownie za chwilę."
+
+def warm_extractors():
+    # submitted back to back, each job spawns its own worker thread -> every worker builds its YoutubeDL up front
+    for _ in range(EXTRACT_WORKERS):
+        extract_pool.submit(time.sleep, 0)
+
+async def run_extract(fn, *args, timeout=EXTRACT_TIMEOUT, default=None, gid=None, priority=PRIO_INTERACTIVE):
+    """Run a blocking yt-dlp call in the pool once admitted (may raise Saturated). Returns `default` on timeout.
+    Cancelling the awaiting task abandons the call (the worker thread finishes it and the result is dropped)."""
+    slot = await extract_slots.acquire(gid, priority)
+    loop = asyncio.get_running_loop()
+    try:
+        fut = loop.run_in_executor(extract_pool, _timed_extract, fn, args)
+    except BaseException:
+        slot.release()
+        raise
+    # the slot stays taken until the worker thread is really done, also when nobody waits anymore
+    fut.add_done_callback(lambda _: slot.release())
+    try:
+        return await asyncio.wait_for(asyncio.shield(fut), timeout)
+    except asyncio.TimeoutError:
+        metrics.inc("m4_extract_timeouts_total", fn=fn.__name__)
+        return default
+
+def _timed_extract(fn, args):
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        metrics.observe("m4_extract_seconds", time.perf_counter() - started, fn=fn.__name__)
+
+# -----------------------
+# Metadata cache: LRU + TTL in front of fetch_info/search, identical in-flight lookups share one extraction
+# -----------------------
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "1024"))
+METADATA_TTL = float(os.getenv("METADATA_TTL", "1800"))
+
+YT_ID_RE = re.compile(r"(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/)([\w-]{11})")
+
+def lookup_key(query_or_url):
+    """Normalized cache key: video id for YouTube links, the url for other links, else the folded query."""
+    q = query_or_url.strip()
+    m = YT_ID_RE.search(q)
+    if m:
+        return f"id:{m.group(1)}"
+    if q.startswith(("http://", "https://")):
+        return f"url:{q}"
+    return "q:" + " ".join(q.lower().split())
+
+class MetadataCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expires, value)
+        self.inflight = {}                         # key -> asyncio.Task
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, keys, value, expires):
+        for key in keys:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def lookup(self, key, load, aliases=lambda value: ()):
+        """Cached value for `key`, or the result of `load()` shared by every concurrent caller."""
+        value = self.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.get_running_loop().create_task(self._load(key, load, aliases))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # shield: one caller giving up must not cancel the extraction the others wait for
+        return await asyncio.shield(task)
+
+    async def _load(self, key, load, aliases):
+        value = await load()
+        if value:
+            expires = time.time() + self.ttl
+            for track in value if isinstance(value, list) else [value]:
+                if track.url:
+                    expires = min(expires, track.expires - STREAM_URL_MARGIN)
+            self.put([key, *aliases(value)], value, expires)
+        return value
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_TTL)
+
+def track_keys(track):
+    keys = []
+    if track.id:
+        keys.append(f"id:{track.id}")
+    if track.webpage:
+        keys.append(lookup_key(track.webpage))
+    return keys
+
+async def fetch_info_async(query_or_url, gid=None, priority=PRIO_INTERACTIVE):
+    # callers mutate tracks (refreshed url...) -> always hand out a copy
+    track = await metadata_cache.lookup(lookup_key(query_or_url),
+                                        lambda: run_extract(fetch_info, query_or_url, gid=gid, priority=priority),
+                                        track_keys)
+    return track.copy() if track else None
+
+async def search_entries_async(query, count=5, gid=None, priority=PRIO_INTERACTIVE):
+    results = await metadata_cache.lookup(f"search{count}:" + lookup_key(query),
+                                          lambda: run_extract(search_entries, query, count, default=[],
+                                                              gid=gid, priority=priority))
+    return [t.copy() for t in results]
+
+async def ensure_stream(track, gid=None, priority=PRIO_PLAYBACK):
+    """Resolve (or refresh) the playable url of a queued track just before it is played."""
+    if track.url and track.expires - STREAM_URL_MARGIN > time.time():
+        return True
+    fresh = await fetch_info_async(track.webpage or track.title, gid, priority)
+    if not fresh or not fresh.url:
+        return False
+    track.url = fresh.url
+    track.expires = fresh.expires
+    track.acodec = fresh.acodec
+    for k in ("id", "webpage", "thumb", "duration"):
+        if not getattr(track, k):
+            setattr(track, k, getattr(fresh, k))
+    return True
+
+# -----------------------
+# Build filter string (bass, main filter) - volume is applied by PCMVolumeTransformer
+# -----------------------
+def build_filter_string(player):
     parts = []
-    vol = volumes.get(gid, 1.0)
-    if vol != 1.0:
-        parts.append(f"volume={vol}")
-    if gid in bass_gain:
-        parts.append(f"bass=g={bass_gain[gid]}")
-    eff = filters.get(gid)
+    if player.bass:
+        parts.append(f"bass=g={player.bass}")
+    eff = player.filter
     if eff == "nightcore":
         parts.append("asetrate=48000*1.25,aresample=48000")
     elif eff == "vaporwave":
@@ -144,128 +745,1717 @@ def build_filter_string(gid):
         return ""
     return ",".join(parts)
 
-def build_ffmpeg_before_and_options(gid, start_offset=None):
-    base_before = FFMPEG_RECONNECT
-    filter_str = build_filter_string(gid)
-    base_options = FFMPEG_BASE
+def build_ffmpeg_before_and_options(player, start_offset=None, local=False):
+    base_before = "" if local else FFMPEG_RECONNECT
+    # with numpy the filters run in DSPSource, ffmpeg only decodes
+    filter_str = build_filter_string(player) if np is None else ""
+    # -ss always goes before -i: input-side seeking jumps via the container index instead of
+    # decoding and discarding everything up to the target
+    before = base_before
+    if start_offset:
+        before = f"{before} -ss {start_offset:.3f}".strip()  # frame-accurate resume / restart
+    options = FFMPEG_BASE
     if filter_str:
-        options = f'{base_options} -af "{filter_str}"'
-        if start_offset:
-            options = f'{options} -ss {int(start_offset)}'
-        before = base_before
-    else:
-        before = base_before
-        if start_offset:
-            before = f"{before} -ss {int(start_offset)}"
-        options = base_options
+        options = f'{options} -af "{filter_str}"'
     return before, options
 
+def use_passthrough(player):
+    """No filters and 100% volume -> hand ffmpeg's Opus straight to discord (no PCM decode/re-encode in-process)."""
+    return not build_filter_string(player) and player.volume == 1.0
+
+def source_key(player):
+    return (use_passthrough(player),) + build_ffmpeg_before_and_options(player)
+
 # -----------------------
-# Playback / position
+# In-process DSP: gain, bass shelf, EQ_PRESETS biquads, nightcore/vaporwave resampling
+# on 20 ms s16le frames - parameters are re-read every frame, the decoder is never restarted
 # -----------------------
-def get_play_position(gid):
-    info = current_song.get(gid)
-    if not info:
-        return 0.0
-    start_time = info.get("start_time")
-    start_offset = info.get("start_offset", 0.0)
-    if start_time is None:
-        return float(start_offset)
-    return float(start_offset + (now_time() - start_time))
-
-def after_wrapper(gid, ctx):
-    def _after(err):
+DSP_RATE = 48000
+FRAME_SAMPLES = 960   # per channel, 20 ms
+FRAME_BYTES = FRAME_SAMPLES * 2 * 2
+SPEED = {"nightcore": 1.25, "vaporwave": 44100 * 0.85 / DSP_RATE}  # same pitch/tempo as the asetrate chains
+
+def dsp_params(player):
+    return (player.volume, player.bass, player.filter)
+
+def parse_af(chain):
+    """'equalizer=f=60:width_type=h:width=100:g=4, bass=g=8' -> [("equalizer", {...}), ("bass", {...})]"""
+    out = []
+    for part in chain.split(","):
+        name, _, args = part.strip().partition("=")
+        if name:
+            out.append((name, dict(kv.split("=", 1) for kv in args.split(":") if "=" in kv)))
+    return out
+
+def _peaking(f, q, g):
+    A = 10 ** (g / 40); w0 = 2 * np.pi * f / DSP_RATE; alpha = np.sin(w0) / (2 * q); c = np.cos(w0)
+    return [1 + alpha * A, -2 * c, 1 - alpha * A, 1 + alpha / A, -2 * c, 1 - alpha / A]
+
+def _lowshelf(f, q, g):
+    A = 10 ** (g / 40); w0 = 2 * np.pi * f / DSP_RATE; alpha = np.sin(w0) / (2 * q); c = np.cos(w0)
+    k = 2 * np.sqrt(A) * alpha
+    return [A * ((A + 1) - (A - 1) * c + k), 2 * A * ((A - 1) - (A + 1) * c), A * ((A + 1) - (A - 1) * c - k),
+            (A + 1) + (A - 1) * c + k, -2 * ((A - 1) + (A + 1) * c), (A + 1) + (A - 1) * c - k]
+
+@functools.lru_cache(maxsize=64)
+def dsp_chain(volume, bass, effect):
+    """-> (sos or None, gain, speed) for one parameter set (RBJ cookbook biquads, matching ffmpeg's bass/equalizer)."""
+    bands = []
+    if bass:
+        bands.append(_lowshelf(100.0, 0.5, bass))
+    if isinstance(effect, str) and effect.startswith("eq:"):
+        for name, p in parse_af(EQ_PRESETS.get(effect.split(":", 1)[1], "")):
+            f = float(p.get("f", 100 if name == "bass" else 1000))
+            w = float(p.get("width", p.get("w", 0.5)))
+            q = f / w if p.get("width_type", p.get("t")) == "h" else w
+            if name == "bass":
+                bands.append(_lowshelf(f, q, float(p.get("g", 0))))
+            elif name == "equalizer":
+                bands.append(_peaking(f, q, float(p.get("g", 0))))
+    sos = None
+    if bands:
+        sos = np.array(bands, dtype=np.float64)
+        sos[:, :3] /= sos[:, 3:4]
+        sos[:, 3:] /= sos[:, 3:4].copy()
+    return sos, float(volume), SPEED.get(effect, 1.0)
+
+class DSPSource(discord.AudioSource):
+    """Filter stage between the PCM decoder and the voice sender. `params()` -> dsp_params tuple."""
+    def __init__(self, source, params):
+        self.source = source
+        self.params = params
+        self.key = None
+        self.sos = None
+        self.zi = None
+        self.gain = 1.0
+        self.speed = 1.0
+        self.buf = np.zeros((0, 2), dtype=np.float32)  # filtered input not yet played
+        self.phase = 0.0                                # fractional read position in buf
+        self.eof = False
+
+    def _configure(self, key):
+        sos, self.gain, self.speed = dsp_chain(*key)
+        if sos is None:
+            self.zi = None
+        elif self.zi is None or self.zi.shape[0] != sos.shape[0]:
+            self.zi = np.zeros((sos.shape[0], 2, 2))
+        self.sos = sos
+        self.key = key
+
+    def read(self):
+        key = self.params()
+        if key != self.key:
+            self._configure(key)
+        if self.sos is None and self.gain == 1.0 and self.speed == 1.0 and not len(self.buf):
+            return self.source.read()
+        need = int(self.phase + FRAME_SAMPLES * self.speed) + 2
+        chunks = [self.buf]
+        have = len(self.buf)
+        while have < need and not self.eof:
+            data = self.source.read()
+            if len(data) < FRAME_BYTES:
+                self.eof = True
+                break
+            x = np.frombuffer(data, dtype=np.int16).reshape(-1, 2).astype(np.float32)
+            if self.sos is not None:
+                x, self.zi = sosfilt(self.sos, x, axis=0, zi=self.zi)
+            chunks.append(x)
+            have += len(x)
+        buf = np.concatenate(chunks) if len(chunks) > 1 else self.buf
+        if self.eof and len(buf) <= self.phase + 1:
+            self.buf = buf[:0]
+            return b""
+        real = len(buf)
+        if real < need:  # last frame of the track: pad with silence
+            buf = np.concatenate((buf, np.zeros((need - real, 2), dtype=np.float32)))
+        if self.speed == 1.0:
+            out = buf[:FRAME_SAMPLES] * self.gain
+            used = FRAME_SAMPLES
+        else:
+            pos = self.phase + np.arange(FRAME_SAMPLES) * self.speed
+            idx = pos.astype(np.int64)
+            frac = (pos - idx)[:, None]
+            out = (buf[idx] * (1.0 - frac) + buf[idx + 1] * frac) * self.gain
+            end = self.phase + FRAME_SAMPLES * self.speed
+            used = int(end)
+            self.phase = end - used
+        self.buf = buf[used:real] if used < real else buf[:0]
+        return np.clip(out, -32768, 32767).astype(np.int16).tobytes()
+
+    def flush(self):
+        """Drop decoded-but-unplayed samples (after the decoder below was seeked)."""
+        self.buf = self.buf[:0]
+        self.phase = 0.0
+        self.eof = False
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        self.source.cleanup()
+
+def decoder_of(source):
+    """Innermost BufferedSource below the DSP / volume wrappers, or None."""
+    while source is not None and not isinstance(source, BufferedSource):
+        source = getattr(source, "source", None) or getattr(source, "original", None)
+    return source
+
+def wrap_output(player, source):
+    """Decoder -> what voice.play() gets: Opus as-is, PCM through DSPSource (or PCMVolumeTransformer without numpy)."""
+    if source.is_opus():
+        return source
+    if np is not None:
+        return DSPSource(source, lambda: dsp_params(player))
+    return discord.PCMVolumeTransformer(source, player.volume)
+
+# -----------------------
+# Audio worker processes (AUDIO_WORKERS > 0): decode + DSP + Opus encode of filtered playback run
+# outside the bot's interpreter, the voice thread here only hands out the encoded packets
+# -----------------------
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "0"))
+AUDIO_WORKER_AHEAD = 25        # frames a pipeline may encode ahead of playback (bounds filter-change latency)
+AUDIO_WORKER_CREDIT_BATCH = 5  # consumed frames are acknowledged in batches
+AUDIO_WORKER_TIMEOUT = 5.0     # seconds without a frame -> treat the pipeline as dead
+AUDIO_WORKER_START_TIMEOUT = 30.0  # same for the first frame (stream open, worker still importing)
+
+def _worker_pipeline(conn, send_lock, pipes, pid, pipe, stream_url, before, options):
+    source = None
+    try:
+        source = DSPSource(discord.FFmpegPCMAudio(stream_url, before_options=before, options=options),
+                           lambda: pipe["params"])
+        encoder = discord.opus.Encoder()
+        while not pipe["stop"].is_set():
+            if not pipe["credit"].acquire(timeout=0.5):
+                continue
+            pcm = source.read()
+            if len(pcm) != FRAME_BYTES:
+                break
+            packet = encoder.encode(pcm, FRAME_SAMPLES)
+            with send_lock:
+                conn.send(("frame", pid, time.monotonic(), packet))
+    except Exception as e:
+        report_error("audio_worker", e)  # this process has no endpoint: the bot counts it again on "failed"
         try:
-            if suppress_after.pop(gid, False):
-                return
-            fut = asyncio.run_coroutine_threadsafe(after_song(ctx), bot.loop)
-            fut.result()
-        except Exception:
+            with send_lock:
+                conn.send(("failed", pid, repr(e)))  # before the first frame the bot falls back, later it recovers
+        except (OSError, ValueError):
+            pass
+    finally:
+        pipes.pop(pid, None)
+        if source is not None:
+            source.cleanup()
+        try:
+            with send_lock:
+                conn.send(("eof", pid))
+        except (OSError, ValueError):
             pass
-    return _after
 
-async def start_playback(ctx, stream_url, title, webpage=None, thumb=None, duration=None, start_offset=0.0, send_np=True):
-    """Use PCM so filters + seek + restart-from-position work reliably."""
-    gid = ctx.guild.id
-    voice = ctx.voice_client
-    if not voice:
-        if ctx.author.voice:
-            await ctx.author.voice.channel.connect()
-            voice = ctx.voice_client
+def audio_worker_main(conn):
+    """Entry point of a worker process: runs every pipeline it is given in its own thread."""
+    send_lock = threading.Lock()
+    pipes = {}  # pipeline id -> {"params", "credit": Semaphore, "stop": Event}
+    while True:
+        try:
+            kind, pid, *args = conn.recv()
+        except (EOFError, OSError):
+            break
+        pipe = pipes.get(pid)
+        if kind == "start":
+            stream_url, before, options, params = args
+            pipe = pipes[pid] = {"params": params, "credit": threading.Semaphore(AUDIO_WORKER_AHEAD),
+                                 "stop": threading.Event()}
+            threading.Thread(target=_worker_pipeline, daemon=True,
+                             args=(conn, send_lock, pipes, pid, pipe, stream_url, before, options)).start()
+        elif pipe is None:
+            continue
+        elif kind == "params":
+            pipe["params"] = args[0]
+        elif kind == "credit":
+            pipe["credit"].release(args[0])
+        elif kind == "stop":
+            pipe["stop"].set()
+    for pipe in list(pipes.values()):
+        pipe["stop"].set()
+
+class FrameStats:
+    """Worker -> voice thread delivery latency of encoded frames."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.stalls = 0  # read() had to wait for the worker
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=3000)
+
+    def record(self, latency):
+        with self.lock:
+            self.frames += 1
+            self.total += latency
+            self.max = max(self.max, latency)
+            self.recent.append(latency)
+
+    def summary(self):
+        with self.lock:
+            recent = sorted(self.recent)
+        if not recent:
+            return None
+        return {"frames": self.frames, "stalls": self.stalls, "mean": self.total / self.frames,
+                "p50": recent[len(recent) // 2], "p99": recent[int(len(recent) * 0.99)], "max": self.max}
+
+frame_stats = FrameStats()
+
+class AudioWorker:
+    def __init__(self, mp):
+        self.conn, child = mp.Pipe()
+        self.proc = mp.Process(target=audio_worker_main, args=(child,), daemon=True, name="audio-worker")
+        self.proc.start()
+        child.close()
+        self.send_lock = threading.Lock()
+        self.pipelines = {}  # pipeline id -> RemoteOpusSource
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def send(self, *msg):
+        try:
+            with self.send_lock:
+                self.conn.send(msg)
+        except (OSError, ValueError):
+            pass
+
+    def _reader(self):
+        while True:
+            try:
+                kind, pid, *args = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            source = self.pipelines.get(pid)
+            if source is not None:
+                source._deliver(kind, args)
+        for source in list(self.pipelines.values()):
+            source._deliver("failed", ("audio worker exited",))
+
+audio_workers = []
+_pipeline_ids = itertools.count(1)
+
+def warm_audio_workers():
+    # spawned workers import this module first (seconds) - do it before the first filtered play
+    audio_workers[:] = [w for w in audio_workers if w.proc.is_alive()]
+    while len(audio_workers) < AUDIO_WORKERS:
+        audio_workers.append(AudioWorker(multiprocessing.get_context("spawn")))
+
+def pick_audio_worker():
+    """Least loaded live worker; dead ones are replaced first."""
+    warm_audio_workers()
+    return min(audio_workers, key=lambda w: len(w.pipelines))
+
+class RemoteOpusSource(discord.AudioSource):
+    """One playback decoded, filtered and encoded in an audio worker. `params()` -> dsp_params tuple,
+    changes are forwarded to the worker and heard within AUDIO_WORKER_AHEAD frames.
+    A pipeline that fails before its first frame is replaced by the same chain run in-process."""
+    def __init__(self, stream_url, before, options, params):
+        self.stream_url = stream_url
+        self.before = before
+        self.options = options
+        self.params = params
+        self.sent = params()
+        self.frames = collections.deque()
+        self.cond = threading.Condition()
+        self.eof = False
+        self.failed = None     # why the worker gave up, when it did before delivering anything
+        self.received = False
+        self.started = False
+        self.fallback = None   # (DSPSource, Encoder) after _fall_back
+        self.closed = False
+        self.consumed = 0
+        self.worker = pick_audio_worker()
+        self.pid = next(_pipeline_ids)
+        self.worker.pipelines[self.pid] = self
+        self.worker.send("start", self.pid, stream_url, before, options, self.sent)
+
+    def _deliver(self, kind, args):
+        # reader thread
+        with self.cond:
+            if kind == "frame":
+                frame_stats.record(time.monotonic() - args[0])
+                self.frames.append(args[1])
+                self.received = True
+            else:
+                if kind == "failed" and not self.received:
+                    self.failed = args[0]  # reported by _fall_back
+                elif kind == "failed":
+                    report_error("audio_worker", RuntimeError(args[0]))  # mid-stream: recovery takes over
+                self.eof = True
+            self.cond.notify()
+
+    def read(self):
+        if self.fallback is not None:
+            return self._read_fallback()
+        key = self.params()
+        if key != self.sent:
+            self.sent = key
+            self.worker.send("params", self.pid, key)
+        with self.cond:
+            if not self.frames and not self.eof:
+                frame_stats.stalls += 1
+                self.cond.wait_for(lambda: self.frames or self.eof,
+                                   AUDIO_WORKER_TIMEOUT if self.started else AUDIO_WORKER_START_TIMEOUT)
+            failed = self.failed
+            if self.frames:
+                packet = self.frames.popleft()
+                self.started = True
+            elif failed is None:
+                return b""
+        if not self.started:
+            return self._fall_back(failed)
+        self.consumed += 1
+        if self.consumed >= AUDIO_WORKER_CREDIT_BATCH:
+            self.worker.send("credit", self.pid, self.consumed)
+            self.consumed = 0
+        return packet
+
+    def _fall_back(self, why):
+        # e.g. no libopus in the worker: every filtered track would die at 0 s, so decode + encode here
+        report_error("audio_worker_fallback", RuntimeError(why))
+        if self.worker.pipelines.pop(self.pid, None) is not None:
+            self.worker.send("stop", self.pid)
+        try:
+            encoder = discord.opus.Encoder()
+            # -y: the worker's ffmpeg may already have created the cache .part file named in options
+            source = DSPSource(discord.FFmpegPCMAudio(self.stream_url, before_options=f"-y {self.before}".strip(),
+                                                      options=self.options), self.params)
+        except Exception as e:
+            report_error("audio_worker_fallback", e)
+            return b""
+        self.fallback = (source, encoder)
+        if self.closed:  # cleaned up by the voice side meanwhile
+            source.cleanup()
+            return b""
+        return self._read_fallback()
+
+    def _read_fallback(self):
+        source, encoder = self.fallback
+        pcm = source.read()
+        if len(pcm) != FRAME_BYTES:
+            return b""
+        return encoder.encode(pcm, FRAME_SAMPLES)
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.closed = True
+        if self.worker.pipelines.pop(self.pid, None) is not None:
+            self.worker.send("stop", self.pid)
+        if self.fallback is not None:
+            self.fallback[0].cleanup()
+
+def live_dsp(source):
+    """Do filter / volume changes reach this voice source without a restart?"""
+    if isinstance(source, DSPSource):
+        return True
+    buf = decoder_of(source)
+    return buf is not None and isinstance(buf.source, RemoteOpusSource)
+
+# -----------------------
+# Audio cache: the first complete play of a track is tee'd to disk by its ffmpeg,
+# later plays / replays / seeks / loops read the local file
+# -----------------------
+CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+CACHE_MAX_BYTES = int(float(os.getenv("AUDIO_CACHE_MB", "2048")) * 1024 * 1024)  # 0 disables the cache
+CACHE_MAX_TRACK = 3 * 3600   # seconds; longer tracks / live streams are never tee'd
+CACHE_PART_STALE = 600       # seconds; older .part files are leftovers of a crash
+
+io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="io")
+
+def probe_duration(path):
+    try:
+        out = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                             capture_output=True, text=True, timeout=30).stdout
+        return float(out.strip())
+    except Exception:
+        return None
+
+class AudioCache:
+    """LRU of <key>.<codec>.mka files capped at max_bytes. Writers use unique .part names and
+    rename only after ffprobe confirms the whole track, so a crash never leaves a truncated entry."""
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()  # key -> (file, size, codec), least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        if max_bytes > 0:
+            self._scan()
+
+    def _scan(self):
+        os.makedirs(self.path, exist_ok=True)
+        found = []
+        for name in os.listdir(self.path):
+            full = os.path.join(self.path, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            if name.endswith(".part"):
+                if time.time() - st.st_mtime > CACHE_PART_STALE:
+                    self._unlink(full)
+            elif name.endswith(".mka") and name.count(".") == 2:
+                key, codec, _ = name.split(".")
+                found.append((st.st_mtime, key, full, st.st_size, codec))
+        for _, key, full, size, codec in sorted(found):
+            self.entries[key] = (full, size, codec)
+            self.bytes += size
+        self._evict()
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def key(track):
+        vid = track.id
+        return re.sub(r"[^\w-]", "_", vid) if vid else None
+
+    def lookup(self, track):
+        """-> (file, codec) of a cached copy or None. Marks the entry as recently used."""
+        key = self.key(track)
+        if self.max_bytes <= 0 or not key:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and not os.path.exists(entry[0]):  # removed behind our back
+                del self.entries[key]
+                self.bytes -= entry[1]
+                entry = None
+            if not entry:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+        try:
+            os.utime(entry[0])  # recency survives restarts
+        except OSError:
+            pass
+        return entry[0], entry[2]
+
+    def part_for(self, track):
+        """Temp file to tee a full play of `track` into, or None if it should not be cached."""
+        key = self.key(track)
+        dur = track.duration
+        if self.max_bytes <= 0 or not key or not dur or dur > CACHE_MAX_TRACK:
+            return None
+        return os.path.join(self.path, f"{key}.{os.getpid()}.{random.getrandbits(32):08x}.part")
+
+    def finish(self, part, track):
+        """Blocking (ffprobe): keep the tee'd file if it holds the whole track, drop it otherwise."""
+        if not os.path.exists(part):
+            return
+        got = probe_duration(part)
+        if not got or abs(got - track.duration) > 3:
+            self._unlink(part)
+            return
+        key = self.key(track)
+        codec = re.sub(r"[^\w]", "", track.acodec or "") or "audio"
+        final = os.path.join(self.path, f"{key}.{codec}.mka")
+        try:
+            os.replace(part, final)
+            size = os.path.getsize(final)
+        except OSError:
+            self._unlink(part)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.bytes -= old[1]
+                if old[0] != final:
+                    self._unlink(old[0])
+            self.entries[key] = (final, size, codec)
+            self.bytes += size
+            self.stats["stores"] += 1
+            self._evict()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.entries:
+            key, (full, size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.stats["evictions"] += 1
+            self._unlink(full)
+
+audio_cache = AudioCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+# -----------------------
+# Play history: newest HISTORY_SIZE plays per guild in memory, every play appended to <HISTORY_DIR>/<guild>.log
+# -----------------------
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_LOG_MAX = 512 * 1024  # bytes; a longer log is compacted to its newest HISTORY_LOG_KEEP lines
+HISTORY_LOG_KEEP = 5000
+
+class PlayEvent:
+    __slots__ = ("ts", "id", "title")
+
+    def __init__(self, ts, id, title):
+        self.ts = ts
+        self.id = id
+        self.title = title
+
+class HistoryLog:
+    """Append-only ts<TAB>id<TAB>title logs, one per guild. Every method blocks -> run them in io_pool."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _file(self, gid):
+        return os.path.join(self.path, f"{gid}.log")
+
+    def append(self, gid, event):
+        title = " ".join(event.title.split())
+        line = f"{event.ts:.3f}\t{event.id or ''}\t{title}\n"
+        with self.lock:
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                with open(self._file(gid), "a", encoding="utf-8") as f:
+                    f.write(line)
+                    size = f.tell()
+                if size > HISTORY_LOG_MAX:
+                    self._compact(gid)
+            except OSError:
+                pass
+
+    def _compact(self, gid):
+        path = self._file(gid)
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines = collections.deque(f, maxlen=HISTORY_LOG_KEEP)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(tmp, path)
+
+    def read(self, gid, limit=None):
+        """Logged events, oldest first. With `limit` only the tail of the file is read."""
+        try:
+            with self.lock, open(self._file(gid), "rb") as f:
+                start = 0
+                if limit:
+                    size = f.seek(0, os.SEEK_END)
+                    start = max(0, size - limit * 200)
+                    f.seek(start)
+                data = f.read()
+        except OSError:
+            return []
+        lines = data.decode("utf-8", "replace").splitlines()
+        if start:
+            lines = lines[1:]  # probably cut in the middle
+        events = []
+        for line in lines:
+            parts = line.split("\t", 2)
+            if len(parts) != 3:
+                continue
+            try:
+                events.append(PlayEvent(float(parts[0]), parts[1] or None, parts[2]))
+            except ValueError:
+                continue
+        return events[-limit:] if limit else events
+
+    def most_played(self, gid, n=10):
+        """-> [(plays, title)] over the whole log, most played first."""
+        counts = collections.Counter()
+        titles = {}
+        for e in self.read(gid):
+            key = e.id or e.title
+            counts[key] += 1
+            titles[key] = e.title
+        return [(c, titles[k]) for k, c in counts.most_common(n)]
+
+history_log = HistoryLog(HISTORY_DIR)
+
+def record_play(player, track):
+    event = PlayEvent(time.time(), track.id, track.title)
+    player.history.append(event)
+    io_pool.submit(history_log.append, player.guild.id, event)
+
+async def load_history(player):
+    """Merge the tail of the guild's log into the in-memory ring (once per player)."""
+    if player.history_loaded:
+        return
+    player.history_loaded = True
+    older = await asyncio.get_running_loop().run_in_executor(io_pool, history_log.read, player.guild.id, HISTORY_SIZE)
+    # plays recorded since the player was created may already be in the log
+    seen = {(round(e.ts, 3), e.id) for e in player.history}
+    merged = [e for e in older if (round(e.ts, 3), e.id) not in seen] + list(player.history)
+    player.history.clear()
+    player.history.extend(merged)
+
+def recent_ids(player):
+    return {e.id for e in player.history if e.id}
+
+# -----------------------
+# Audio sources / prefetch (next track is resolved + decoded ahead of time)
+# -----------------------
+PREFETCH_LEAD = float(os.getenv("PREFETCH_LEAD", "15"))    # seconds before the current track ends (<=0 disables)
+PREFETCH_FRAMES = int(os.getenv("PREFETCH_FRAMES", "50"))  # 20 ms frames decoded ahead (50 == 1 s)
+
+SEEK_RING_SECONDS = float(os.getenv("SEEK_RING_SECONDS", "15"))  # recently played audio kept for instant seeks back
+FRAME_SECONDS = 0.02
+
+JITTER_START_FRAMES = 25  # read-ahead kept by a fresh source (500 ms)
+JITTER_MIN_FRAMES = 10
+JITTER_MAX_FRAMES = int(os.getenv("JITTER_MAX_FRAMES", "250"))  # 5 s, 0 disables the reader thread
+JITTER_DECAY_SECONDS = 30.0  # underrun-free time after which the read-ahead shrinks by a quarter
+PCM_SILENCE = bytes(FRAME_BYTES)
+OPUS_SILENCE = b"\xf8\xff\xfe"
+jitter_stats = {"underruns": 0, "grown": 0, "shrunk": 0}
+
+class BufferedSource(discord.AudioSource):
+    """Wraps a decoder (20 ms PCM frames or Opus packets). A reader thread keeps `target` frames ahead
+    of the voice thread, so read() never waits on ffmpeg: when the read-ahead runs dry it returns
+    silence (an underrun, which doubles `target`; quiet periods shrink it again).
+    The last SEEK_RING_SECONDS of played frames are kept so seek() can move inside
+    [position - ring, position + read-ahead] without touching ffmpeg."""
+    def __init__(self, source, tee=None, start_offset=0.0):
+        self.source = source
+        self.ahead = collections.deque()
+        self.played = collections.deque(maxlen=int(SEEK_RING_SECONDS / FRAME_SECONDS))
+        self.start_offset = float(start_offset)
+        self.index = 0  # frames served since start_offset (silence of underruns not counted)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.tee = tee  # (part file, track) being written by this decoder
+        self.slot = None  # decoder_slots admission of the ffmpeg process below (None when shared)
+        self.af = ""      # ffmpeg -af chain the decoder was started with (only used without numpy)
+        self.expected = None   # track duration; EOF well before it is a failure, not the end
+        self.failed_at = None  # time.monotonic() of such an early EOF
+        # worker pipelines already run ahead in their own process (bounded for filter-change latency)
+        self.jitter = JITTER_MAX_FRAMES > 0 and not isinstance(source, RemoteOpusSource)
+        self.reader = None
+        self.eof = False
+        self.closed = False
+        self.target = min(JITTER_START_FRAMES, JITTER_MAX_FRAMES)
+        self.underruns = 0
+        self.starved = True    # no frame since the last underrun (or since start)
+        self.adjusted = self.opened = time.monotonic()
+        self.first_frame = False
+
+    @property
+    def position(self):
+        return self.start_offset + self.index * FRAME_SECONDS
+
+    @property
+    def fill(self):
+        return len(self.ahead)
+
+    def prefill(self, frames):
+        # blocking (ffmpeg has to open the remote stream) - call from a worker thread, before playback
+        while len(self.ahead) < frames:
+            data = self.source.read()
+            if not data:
+                self.eof = True
+                break
+            if not self.first_frame:
+                self._first_frame()
+            with self.lock:
+                self.ahead.append(data)
+
+    def _fill(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.ahead) >= self.target:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            try:
+                data = self.source.read()
+            except Exception:
+                data = b""  # cleaned up under us
+            if data and not self.first_frame:
+                self._first_frame()
+            with self.cond:
+                if not data or self.closed:
+                    self.eof = True
+                    return
+                self.ahead.append(data)
+
+    def read(self):
+        if not self.jitter:
+            return self._read_direct()
+        if self.reader is None and not self.eof:
+            self.reader = threading.Thread(target=self._fill, name="jitter-reader", daemon=True)
+            self.reader.start()
+        with self.cond:
+            if self.ahead:
+                data = self.ahead.popleft()
+                self.cond.notify()
+                self.played.append(data)
+                self.index += 1
+            else:
+                data = b"" if self.eof else None
+        if data is None:
+            return self._underrun()
+        if not data:
+            return self._ended()
+        now = time.monotonic()
+        self.starved = False
+        if now - self.adjusted >= JITTER_DECAY_SECONDS and self.target > JITTER_MIN_FRAMES:
+            self.target = max(JITTER_MIN_FRAMES, self.target - self.target // 4)
+            self.adjusted = now
+            jitter_stats["shrunk"] += 1
+        return data
+
+    def _underrun(self):
+        # the decoder is late: keep the 20 ms cadence with silence, read further ahead from now on
+        if not self.starved:  # not while ffmpeg is still opening the stream
+            self.starved = True
+            self.underruns += 1
+            jitter_stats["underruns"] += 1
+            if self.target < JITTER_MAX_FRAMES:
+                with self.cond:
+                    self.target = min(JITTER_MAX_FRAMES, self.target * 2)
+                    self.cond.notify()
+                jitter_stats["grown"] += 1
+            self.adjusted = time.monotonic()
+        return OPUS_SILENCE if self.is_opus() else PCM_SILENCE
+
+    def _first_frame(self):
+        # decoder spawn (or join of a shared one) -> first decoded frame
+        self.first_frame = True
+        kind = ("shared" if isinstance(self.source, SharedSubscriber)
+                else "worker" if isinstance(self.source, RemoteOpusSource) else "ffmpeg")
+        metrics.observe("m4_decoder_first_frame_seconds", time.monotonic() - self.opened, decoder=kind)
+
+    def _ended(self):
+        if self.expected and self.position < self.expected - RECOVER_TOLERANCE:
+            self.failed_at = time.monotonic()
+        return b""
+
+    def _read_direct(self):
+        with self.lock:
+            data = self.ahead.popleft() if self.ahead else None
+        if data is None:
+            data = self.source.read()
+            if not data:
+                return self._ended()
+            if not self.first_frame:
+                self._first_frame()
+        with self.lock:
+            self.played.append(data)
+            self.index += 1
+        return data
+
+    def seek(self, seconds):
+        """Move to `seconds` using only buffered frames. False -> caller has to restart the decoder."""
+        with self.lock:
+            delta = int(round((seconds - self.start_offset) / FRAME_SECONDS)) - self.index
+            if delta < 0 and -delta <= len(self.played):
+                for _ in range(-delta):
+                    self.ahead.appendleft(self.played.pop())
+            elif 0 <= delta <= len(self.ahead):
+                for _ in range(delta):
+                    self.played.append(self.ahead.popleft())
+            else:
+                return False
+            self.index += delta
+            return True
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            self.ahead.clear()
+            self.played.clear()
+        self.source.cleanup()
+        if self.slot:
+            self.slot.release()
+        if self.tee:
+            io_pool.submit(audio_cache.finish, *self.tee)
+            self.tee = None
+
+# -----------------------
+# Shared decode fan-out: guilds starting the same track (same decode settings) within FANOUT_JOIN_SECONDS
+# read one ffmpeg process with their own cursors; a subscriber that falls behind gets a private decoder
+# -----------------------
+FANOUT = os.getenv("FANOUT", "1") != "0"
+FANOUT_JOIN_SECONDS = 10.0    # a decoder accepts new subscribers (from 0) only this close to the start
+FANOUT_WINDOW_SECONDS = 30.0  # max frames kept behind the newest one for slower (paused) subscribers
+
+shared_decoders = {}  # (video id, local, passthrough, ffmpeg filter) -> SharedDecoder still accepting subscribers
+fanout_lock = threading.Lock()
+fanout_stats = {"decoders": 0, "joins": 0, "fallbacks": 0}
+
+class SharedDecoder:
+    def __init__(self, key, source, tee, slot):
+        self.key = key
+        self.source = source
+        self.tee = tee
+        self.slot = slot
+        self.frames = collections.deque()
+        self.base = 0  # index of frames[0]
+        self.eof = False
+        self.subscribers = set()
+        self.lock = threading.Lock()       # frames / subscribers, held only briefly
+        self.read_lock = threading.Lock()  # serialises source.read()
+        self.closed = False
+
+    @property
+    def head(self):
+        return self.base + len(self.frames)
+
+    def joinable(self):
+        return not self.closed and self.base == 0 and self.head * FRAME_SECONDS < FANOUT_JOIN_SECONDS
+
+    def subscribe(self, sub):
+        with self.lock:
+            self.subscribers.add(sub)
+
+    def _cached(self, index):
+        # under self.lock: the frame, b"" at EOF, None if dropped, False if nobody read it yet
+        if index < self.base:
+            return None
+        if index < self.head:
+            return self.frames[index - self.base]
+        if self.eof or self.closed:
+            return b""
+        return False
+
+    def frame(self, index):
+        """Frame `index` (read from ffmpeg if nobody did yet), b"" at EOF, None if it was already dropped."""
+        with self.lock:
+            data = self._cached(index)
+        if data is not False:
+            return data
+        # one subscriber at a time waits on the pipe; self.lock stays free so joins / leaves
+        # (event loop) never block on ffmpeg
+        with self.read_lock:
+            with self.lock:
+                data = self._cached(index)  # another subscriber may have read it meanwhile
+            if data is not False:
+                return data
+            data = self.source.read()
+            with self.lock:
+                if self.closed:
+                    return b""
+                if not data:
+                    self.eof = True
+                    return b""
+                self.frames.append(data)
+                # keep the start while late joiners may come, then only what the slowest subscriber still needs
+                if self.head * FRAME_SECONDS >= FANOUT_JOIN_SECONDS and self.subscribers:
+                    keep_from = max(min(s.index for s in self.subscribers),
+                                    self.head - int(FANOUT_WINDOW_SECONDS / FRAME_SECONDS))
+                    while self.base < keep_from:
+                        self.frames.popleft()
+                        self.base += 1
+                return data
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+            if self.subscribers or self.closed:
+                return
+            self.closed = True
+            self.frames.clear()
+        with fanout_lock:
+            if shared_decoders.get(self.key) is self:
+                del shared_decoders[self.key]
+        self.source.cleanup()
+        if self.slot:
+            self.slot.release()
+        if self.tee:
+            io_pool.submit(audio_cache.finish, *self.tee)
+            self.tee = None
+
+class SharedSubscriber(discord.AudioSource):
+    """One guild's cursor into a SharedDecoder. `fallback(seconds)` -> (private decoder, its slot)."""
+    def __init__(self, shared, fallback):
+        self.shared = shared
+        self.fallback = fallback
+        self.opus = shared.source.is_opus()
+        self.index = 0
+        self.private = None
+        self.private_slot = None
+        shared.subscribe(self)
+
+    def read(self):
+        if self.private is not None:
+            return self.private.read()
+        data = self.shared.frame(self.index)
+        if data is None:  # fell out of the shared window -> own decoder from here on
+            self.private, self.private_slot = self.fallback(self.index * FRAME_SECONDS)
+            fanout_stats["fallbacks"] += 1
+            self._leave()
+            return self.private.read()
+        if data:
+            self.index += 1
+        return data
+
+    def is_opus(self):
+        return self.opus
+
+    def _leave(self):
+        shared, self.shared = self.shared, None
+        if shared is not None:
+            shared.unsubscribe(self)
+
+    def cleanup(self):
+        self._leave()
+        if self.private is not None:
+            self.private.cleanup()
+            self.private_slot.release()
+
+def make_source(player, track, start_offset=0.0, local=None, slot=None):
+    """Decoder for `track` wrapped in a BufferedSource. Plays from 0 share a decoder with other guilds
+    when possible (not for worker-process pipelines, those decode per guild).
+    slot: decoder_slots admission for a new ffmpeg process, released right away when an existing one is joined."""
+    passthrough = use_passthrough(player)
+    remote = AUDIO_WORKERS > 0 and np is not None and not passthrough
+    # with in-process DSP the filters run per guild after decoding, ffmpeg gets no -af chain
+    af = build_filter_string(player) if np is None else ""
+    if not FANOUT or start_offset or not track.id or remote:
+        try:
+            source, tee = open_decoder(player, track, start_offset, local)
+        except BaseException:
+            if slot:
+                slot.release()
+            raise
+        buf = BufferedSource(source, tee, start_offset)
+        buf.slot = slot
+        buf.af = af
+        buf.expected = track.duration
+        return buf
+    key = (track.id, bool(local), passthrough, af)
+    gid = player.guild.id
+    with fanout_lock:
+        shared = shared_decoders.get(key)
+        if shared is not None and shared.joinable():
+            fanout_stats["joins"] += 1
+            if slot:
+                slot.release()
         else:
-            return await ctx.send("❌ Musisz być na kanale głosowym.")
-    current_song[gid] = {
-        "url": stream_url,
-        "title": title,
-        "webpage": webpage,
-        "thumb": thumb,
-        "duration": duration,
-        "start_time": now_time(),
-        "start_offset": float(start_offset)
-    }
-    before, options = build_ffmpeg_before_and_options(gid, start_offset if start_offset else None)
-    volume = volumes.get(gid, 1.0)
+            try:
+                source, tee = open_decoder(player, track, 0.0, local)
+            except BaseException:
+                if slot:
+                    slot.release()
+                raise
+            if slot:
+                # the decoder outlives the opener's subscription -> charge it to no guild
+                slot.disown()
+            shared = shared_decoders[key] = SharedDecoder(key, source, tee, slot)
+            fanout_stats["decoders"] += 1
+        sub = SharedSubscriber(shared, lambda pos: (open_decoder(player, track, pos, local, passthrough)[0],
+                                                    decoder_slots.take(gid)))
+    buf = BufferedSource(sub, None, 0.0)
+    buf.af = af
+    buf.expected = track.duration
+    return buf
+
+def open_decoder(player, track, start_offset=0.0, local=None, passthrough=None):
+    """-> (ffmpeg source, tee). local: (file, codec) from audio_cache.lookup(); otherwise the remote url is
+    played and, when starting from 0, also copied (-c:a copy) to a cache .part file by the same ffmpeg process."""
+    stream_url = local[0] if local else track.url
+    acodec = local[1] if local else track.acodec
+    before, options = build_ffmpeg_before_and_options(player, start_offset if start_offset else None, local=bool(local))
+    part = None if local or start_offset else audio_cache.part_for(track)
+    if passthrough is None:
+        passthrough = use_passthrough(player)
+    # YouTube bestaudio is usually Opus already -> stream copy; other codecs are encoded by ffmpeg
+    codec = "opus" if acodec == "opus" else None
+    if part:
+        # discord.py's own output args apply to the first output (the cache file), so repeat them for pipe:1
+        if passthrough:
+            pipe_args = f"-map_metadata -1 -f opus -c:a {'copy' if codec else 'libopus'} -ar 48000 -ac 2 -b:a 128k"
+        else:
+            pipe_args = "-f s16le -ar 48000 -ac 2"
+        options = f'-vn -c:a copy -f matroska "{part}" {pipe_args} {options}'
+    tee = (part, track) if part else None
+    if passthrough:
+        return discord.FFmpegOpusAudio(stream_url, before_options=before, options=options, codec=codec), tee
+    if AUDIO_WORKERS > 0 and np is not None:
+        return RemoteOpusSource(stream_url, before, options, lambda: dsp_params(player)), tee
     try:
         ff = discord.FFmpegPCMAudio(stream_url, before_options=before, options=options)
-    except Exception:
+    except Exception as e:
+        report_error("ffmpeg_spawn", e)
         ff = discord.FFmpegPCMAudio(stream_url)
-    source = discord.PCMVolumeTransformer(ff, volume)
-    voice.play(source, after=after_wrapper(gid, ctx))
-    get_history(gid).append(title)
+        tee = None
+    return ff, tee
+
+def next_track(player):
+    if player.loop_mode == 1:
+        return player.current
+    return player.queue[0] if player.queue else autoplay_pick(player)
+
+def drop_prefetch(player):
+    if player.prefetch_task:
+        player.prefetch_task.cancel()
+        player.prefetch_task = None
+    pf, player.prefetch = player.prefetch, None
+    if pf:
+        pf["source"].cleanup()
+
+def take_prefetched(player, track):
+    """Hand over the warm source if it was built for this track with the current filter chain."""
+    pf = player.prefetch
+    if not pf:
+        return None
+    player.prefetch = None
+    # warmed for another track / filter chain: nothing will use it anymore, free its decoder slot
+    if pf["track"] is not track or pf["key"] != source_key(player):
+        pf["source"].cleanup()
+        return None
+    return pf["source"]
+
+async def _prefetch_later(player, delay):
+    await asyncio.sleep(delay)
+    track = next_track(player)
+    if not track:
+        return
+    key = source_key(player)
+    pf = player.prefetch
+    if pf and pf["track"] is track and pf["key"] == key:
+        return
+    if pf:
+        player.prefetch = None
+        pf["source"].cleanup()
+    gid = player.guild.id
+    try:
+        local = audio_cache.lookup(track)
+        if not local and not await ensure_stream(track, gid, PRIO_INTERACTIVE):
+            return
+        slot = await decoder_slots.acquire(gid, PRIO_INTERACTIVE)
+    except Saturated:
+        return  # busy: the track is simply started cold
+    source = make_source(player, track, local=local, slot=slot)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, source.prefill, PREFETCH_FRAMES)
+    except BaseException:
+        source.cleanup()
+        raise
+    player.prefetch = {"track": track, "key": key, "source": source}
+
+def schedule_prefetch(player):
+    """(Re)arm the prefetch timer and mark the guild for the next state flush;
+    call after playback starts/restarts and after queue changes."""
+    mark_dirty(player)
+    schedule_autoplay(player)
+    if player.prefetch_task:
+        player.prefetch_task.cancel()
+        player.prefetch_task = None
+    info = player.current
+    nxt = next_track(player)
+    pf = player.prefetch
+    if pf and pf["track"] is not nxt:
+        drop_prefetch(player)  # queue / loop / autoplay changed: the warm decoder is for nothing now
+    if PREFETCH_LEAD <= 0 or not info or not info.duration or not nxt:
+        return
+    delay = max(0.0, info.duration - get_play_position(player) - PREFETCH_LEAD)
+    player.prefetch_task = asyncio.get_running_loop().create_task(_prefetch_later(player, delay))
+
+# -----------------------
+# Autoplay: the follow-up of the current track is picked and resolved while it still plays,
+# then warmed by the prefetch like a queued track
+# -----------------------
+AUTOPLAY_CANDIDATES = int(os.getenv("AUTOPLAY_CANDIDATES", "8"))  # related results considered
+AUTOPLAY_RESOLVE = 3                                              # candidates resolved at once
+RELATED_TTL = 6 * 3600
+
+related_cache = MetadataCache(METADATA_CACHE_SIZE, RELATED_TTL)   # "related:<video id>" -> [Track]
+
+def _title_key(title):
+    # "Song (Official Video)" and "Song [Lyrics]" are the same song
+    title = re.sub(r"[(\[].*?[)\]]", " ", (title or "").lower())
+    return " ".join(re.findall(r"\w+", title))
+
+def autoplay_pick(player):
+    pick = player.autoplay_next
+    if player.autoplay and pick and pick[0] is player.current:
+        return pick[1]
+    return None
+
+async def pick_autoplay(player, base, priority):
+    """First related track of `base` not played recently whose url resolves. Raises Saturated."""
+    gid = player.guild.id
+    key = "related:" + (base.id or lookup_key(base.title))
+    related = await related_cache.lookup(key, lambda: run_extract(
+        search_entries, base.title, AUTOPLAY_CANDIDATES, default=[], gid=gid, priority=priority))
+    await load_history(player)
+    seen_ids = recent_ids(player) | {t.id for t in player.queue} | {base.id}
+    seen_titles = {_title_key(e.title) for e in player.history} | {_title_key(base.title)}
+    candidates = [t.copy() for t in related
+                  if t.id and t.id not in seen_ids and _title_key(t.title) not in seen_titles]
+    saturated = False
+    for i in range(0, len(candidates), AUTOPLAY_RESOLVE):
+        batch = candidates[i:i + AUTOPLAY_RESOLVE]
+        results = await asyncio.gather(*(ensure_stream(t, gid, priority) for t in batch),
+                                       return_exceptions=True)
+        for track, ok in zip(batch, results):
+            if ok is True:
+                return track
+            saturated = saturated or isinstance(ok, Saturated)
+    if saturated:
+        raise Saturated()
+    return None
+
+def schedule_autoplay(player):
+    base = player.current
+    if (not player.autoplay or not base or not base.title or player.queue or player.loop_mode == 1
+            or autoplay_pick(player)):
+        return
+    pending = player.autoplay_task
+    if pending and not pending[1].done():
+        if pending[0] is base:
+            return
+        pending[1].cancel()
+    task = asyncio.get_running_loop().create_task(_autoplay_ahead(player, base))
+    player.autoplay_task = (base, task)
+
+async def _autoplay_ahead(player, base):
+    try:
+        track = await pick_autoplay(player, base, PRIO_INTERACTIVE)
+    except Saturated:
+        return  # picked when the track ends
+    if track and player.current is base and players.get(player.guild.id) is player:
+        player.autoplay_next = (base, track)
+        schedule_prefetch(player)
+
+# -----------------------
+# Playback / position
+# -----------------------
+def get_play_position(player):
+    """Seconds into the current track: frames actually handed to the voice client when a decoder is
+    playing (exact, stops while paused), wall clock since start otherwise."""
+    if not player.current:
+        return 0.0
+    v = player.guild.voice_client
+    buf = decoder_of(getattr(v, "source", None)) if v else None
+    if buf is not None:
+        return buf.position
+    if player.start_time is None:
+        return float(player.start_offset)
+    return float(player.start_offset + (now_time() - player.start_time))
+
+async def ensure_voice(ctx):
+    """Voice client of ctx.guild, connecting to the author's channel if needed. None -> already told the user."""
+    if ctx.voice_client:
+        return ctx.voice_client
+    if ctx.author.voice:
+        return await ctx.author.voice.channel.connect()
+    await ctx.send("❌ Musisz być na kanale głosowym.")
+    return None
+
+async def start_playback(player, track, start_offset=0.0, send_np=True, restart=False):
+    """Start `track` at start_offset on a BufferedSource: Opus passthrough without filters / volume change,
+    PCM through DSPSource (or an audio worker) otherwise.
+    restart: same play continued (seek / filter / replay) -> not a new history event.
+    Returns False if the track could not be started (no voice / url not resolvable).
+    Raises Saturated when no decoder / extraction could be admitted.
+    Only the transition consumer calls this."""
+    voice = player.guild.voice_client
+    if not voice:
+        return False
+    gid = player.guild.id
+    source = take_prefetched(player, track) if not start_offset else None
+    if source is None:
+        local = audio_cache.lookup(track)
+        if not local and not await ensure_stream(track, gid, PRIO_PLAYBACK):
+            return False
+        slot = await decoder_slots.acquire(gid, PRIO_PLAYBACK)
+        source = make_source(player, track, start_offset, local, slot)
+    stop_playback(player)  # never voice.play() over a live source
+    player.generation += 1
+    gen = player.generation
+    player.start_time = now_time()
+    player.start_offset = float(start_offset)
+    player.current = track
+    buf = decoder_of(source)
+    voice.play(wrap_output(player, source),
+               after=lambda err: post_event(player, "errored" if err or (buf and buf.failed_at) else "ended",
+                                            gen, err, 0, buf))
+    player.state = "playing"
+    if not restart:
+        player.recoveries = 0
+        record_play(player, track)
+    schedule_prefetch(player)
     if send_np:
-        await send_now_playing(ctx, gid)
+        await send_now_playing(player)
+    return True
 
-async def after_song(ctx):
-    gid = ctx.guild.id
-    q = get_queue(gid)
-    v = ctx.voice_client
-    mode = loop_mode.get(gid, 0)
-    if mode == 1:
-        info = current_song.get(gid)
-        if info:
-            await start_playback(ctx, info["url"], info["title"], info.get("webpage"), info.get("thumb"), info.get("duration"), start_offset=0.0)
+def stop_playback(player):
+    """Stop without advancing: the stopped source's 'ended' event carries an old generation."""
+    player.generation += 1
+    player.state = "idle"
+    v = player.guild.voice_client
+    if v and (v.is_playing() or v.is_paused()):
+        v.stop()
+
+# -----------------------
+# Mid-stream recovery: a stream that ends well before the track's duration (expired url, 403,
+# stall cut by -rw_timeout) is re-resolved and resumed at the last frame actually played
+# -----------------------
+RECOVER_TOLERANCE = 5.0  # seconds short of the duration that still count as the normal end
+RECOVER_ATTEMPTS = 3     # per track, then it is skipped
+recovery_stats = {"recovered": 0, "failed": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+async def refresh_stream(track, gid):
+    """New url for `track` straight from yt-dlp: the cached one is what just failed."""
+    fresh = await run_extract(fetch_info, track.webpage or track.title, gid=gid, priority=PRIO_PLAYBACK)
+    if not fresh or not fresh.url:
+        return False
+    track.url = fresh.url
+    track.expires = fresh.expires
+    track.acodec = fresh.acodec
+    metadata_cache.put(track_keys(track), fresh,
+                       min(time.time() + metadata_cache.ttl, fresh.expires - STREAM_URL_MARGIN))
+    return True
+
+async def recover_stream(player, buf, error):
+    """Resume the current track where `buf` stopped. False -> give up, advance as if it had ended."""
+    track = player.current
+    if buf is None or not track or player.recoveries >= RECOVER_ATTEMPTS:
+        return False
+    failed_at = buf.failed_at or time.monotonic()
+    pos = buf.position
+    gid = player.guild.id
+    player.recoveries += 1
+    report_error("stream_failed", RuntimeError(f"{track.id} at {pos:.1f}s in guild {gid} ({error!r}), resuming"))
+    try:
+        ok = await refresh_stream(track, gid) and await start_playback(
+            player, track, start_offset=pos, send_np=False, restart=True)
+    except Saturated:
+        ok = False
+    if not ok:
+        recovery_stats["failed"] += 1
+        return False
+    latency = time.monotonic() - failed_at
+    recovery_stats["recovered"] += 1
+    recovery_stats["latency_total"] += latency
+    recovery_stats["latency_max"] = max(recovery_stats["latency_max"], latency)
+    return True
+
+# -----------------------
+# Track transitions: one event queue + one consumer task per guild.
+# The voice thread only posts; generations tell events of the current playback
+# from those of a playback that was already restarted / skipped / stopped.
+#   ("ended" | "errored", gen, error, attempt, decoder)   source finished / failed (decoder: BufferedSource or None)
+#   ("skipped", gen)                             user skip
+#   ("restarted", track, pos, send_np, fut)      track again from pos (seek, filters, replay),
+#                                                dropped if another track is current by then
+#   ("play", track, fut)                         start now if idle, else enqueue
+# -----------------------
+SATURATED_RETRY = 10.0  # seconds before a saturated transition is tried again
+SATURATED_RETRIES = 3
+
+def post_event(player, kind, *args):
+    """Thread-safe, never blocks (called from the voice thread by the after callback)."""
+    try:
+        bot.loop.call_soon_threadsafe(_post, player, (kind,) + args)
+    except RuntimeError:
+        pass  # loop closed during shutdown
+
+def _post(player, event):
+    if players.get(player.guild.id) is not player:
+        _resolve(event, None)  # released meanwhile
+        return
+    if player.event_task is None or player.event_task.done():
+        player.events = asyncio.Queue()
+        player.event_task = asyncio.get_running_loop().create_task(_run_events(player))
+    player.events.put_nowait(event)
+
+def _resolve(event, result):
+    fut = event[-1]
+    if isinstance(fut, asyncio.Future) and not fut.done():
+        if isinstance(result, BaseException):
+            fut.set_exception(result)
+        else:
+            fut.set_result(result)
+
+async def _request(player, kind, *args):
+    fut = asyncio.get_running_loop().create_future()
+    _post(player, (kind,) + args + (fut,))
+    return await fut
+
+async def request_play(player, track):
+    """'started' | 'queued' | 'failed' (None if the player was released). Raises Saturated."""
+    return await _request(player, "play", track)
+
+async def request_restart(player, pos, send_np=False):
+    """Restart the current track at pos. False if it could not / no longer applies. Raises Saturated."""
+    return await _request(player, "restarted", player.current, pos, send_np)
+
+def request_skip(player):
+    post_event(player, "skipped", player.generation)
+
+async def _run_events(player):
+    events = player.events
+    try:
+        while True:
+            event = await events.get()
+            try:
+                await _handle_event(player, event)
+            except asyncio.CancelledError:
+                _resolve(event, None)
+                raise
+            except Exception as e:
+                if not isinstance(e, Saturated):
+                    report_error(f"transition_{event[0]}", e)
+                _resolve(event, e)
+    finally:
+        while not events.empty():
+            _resolve(events.get_nowait(), None)
+
+async def _handle_event(player, event):
+    kind = event[0]
+    if kind == "play":
+        track = event[1]
+        if player.state == "idle":
+            _resolve(event, "started" if await start_playback(player, track) else "failed")
+        else:
+            player.queue.append(track)
+            if len(player.queue) == 1:
+                schedule_prefetch(player)
+            _resolve(event, "queued")
+        return
+    if kind == "restarted":
+        _, track, pos, send_np, _ = event
+        ok = track is not None and track is player.current and await start_playback(
+            player, track, start_offset=pos, send_np=send_np, restart=True)
+        _resolve(event, ok)
+        return
+    if event[1] != player.generation:
+        return  # belongs to a playback that was already replaced
+    if kind == "skipped":
+        stop_playback(player)
+    elif kind == "errored":
+        if await recover_stream(player, event[4], event[2]):
             return
-    if q:
-        item = q.pop(0)
-        if len(item) >= 5:
-            url,title,web,thumb,dur = item
+        report_error("playback", event[2] or RuntimeError(f"stream ended early in guild {player.guild.id}"))
+    player.state = "idle"
+    attempt = event[3] if kind in ("ended", "errored") else 0
+    try:
+        await _advance(player)
+        if player.state == "idle":
+            touch_panel(player)  # nothing next: the panel shows the end
+    except Saturated:
+        if players.get(player.guild.id) is not player:
+            return
+        if attempt < SATURATED_RETRIES:
+            if player.channel and attempt == 0:
+                await player.channel.send("⏳ Bot jest przeciążony, kolejny utwór za chwilę...")
+            # a later play/skip bumps the generation and makes this retry stale
+            asyncio.get_running_loop().call_later(
+                SATURATED_RETRY, post_event, player, "ended", player.generation, None, attempt + 1, None)
+        elif player.channel:
+            await player.channel.send(SATURATED_MSG + " Użyj !skip, aby wznowić kolejkę.")
+
+async def _advance(player):
+    if players.get(player.guild.id) is not player:
+        return  # released while the track was ending
+    q = player.queue
+    if player.loop_mode == 1:
+        info = player.current
+        if info and await start_playback(player, info, start_offset=0.0):
+            return
+    while q:
+        item = q[0]
+        ok = await start_playback(player, item, start_offset=0.0)  # Saturated -> item stays queued
+        if q and q[0] is item:
+            q.popleft()
+        if ok:
+            return
+        if player.channel:
+            await player.channel.send(f"⚠️ Pominięto niedostępny utwór: **{item.title}**")
+    if player.autoplay and player.current:
+        base = player.current
+        track = autoplay_pick(player)
+        pending = player.autoplay_task
+        if track is None and pending and pending[0] is base and not pending[1].done():
+            await asyncio.wait([pending[1]])  # still picking in the background
+            track = autoplay_pick(player)
+        if track is None:
+            track = await pick_autoplay(player, base, PRIO_PLAYBACK)  # Saturated -> retried later
+        if track and await start_playback(player, track, start_offset=0.0):
+            return
+    # nothing next -> leave bot in VC, keep player.current
+
+# -----------------------
+# Playlist ingestion: entries go into the queue while yt-dlp is still paging,
+# the first one starts right away, a few upcoming ones are resolved in the background
+# -----------------------
+PLAYLIST_RESOLVE_AHEAD = int(os.getenv("PLAYLIST_RESOLVE_AHEAD", "5"))
+PLAYLIST_RESOLVE_CONCURRENCY = int(os.getenv("PLAYLIST_RESOLVE_CONCURRENCY", "2"))
+PLAYLIST_PROGRESS_EVERY = 3.0  # seconds between progress message edits
+PLAYLIST_TIMEOUT = float(os.getenv("PLAYLIST_TIMEOUT", "300"))  # deadline for paging a whole playlist
+
+def cancel_ingest(player):
+    job, player.playlist_job = player.playlist_job, None
+    if job:
+        job["cancel"].set()
+        job["task"].cancel()
+
+async def _resolve_ahead(sem, track, gid):
+    async with sem:
+        try:
+            await ensure_stream(track, gid, PRIO_BULK)
+        except Saturated:
+            pass  # resolved when it is played
+
+async def ingest_playlist(player, url, job):
+    loop = asyncio.get_running_loop()
+    try:
+        # paging occupies an extraction worker for the whole playlist
+        slot = await extract_slots.acquire(player.guild.id, PRIO_BULK)
+    except Saturated:
+        if player.playlist_job is job:
+            player.playlist_job = None
+        return await player.channel.send(SATURATED_MSG)
+    incoming = asyncio.Queue()
+    push = lambda track: loop.call_soon_threadsafe(incoming.put_nowait, track)
+    paging = loop.run_in_executor(extract_pool, fetch_playlist_entries, url, push, job["cancel"])
+    paging.add_done_callback(lambda _: slot.release())
+    sem = asyncio.Semaphore(PLAYLIST_RESOLVE_CONCURRENCY)
+    resolvers = []
+    starting = True  # until an entry actually starts (or queues behind something already playing)
+    status = await player.channel.send("📥 Wczytuję playlistę...")
+    last_edit = now_time()
+    deadline = last_edit + PLAYLIST_TIMEOUT
+    timed_out = False
+    try:
+        while True:
+            try:
+                track = await asyncio.wait_for(incoming.get(), max(0.0, deadline - now_time()))
+            except asyncio.TimeoutError:
+                # paging stops at the next entry; a stalled page ends with socket_timeout
+                job["cancel"].set()
+                metrics.inc("m4_extract_timeouts_total", fn="fetch_playlist_entries")
+                timed_out = True
+                break
+            if track is None:
+                break
+            job["added"] += 1
+            if starting:
+                try:
+                    result = await request_play(player, track)
+                except Saturated:
+                    result = None
+                    # stays queued; the idle player retries it through the usual saturated back-off
+                    if player.state == "idle" and players.get(player.guild.id) is player:
+                        post_event(player, "ended", player.generation, None, 0, None)
+                if result in ("started", "queued"):
+                    starting = False
+                    continue
+                if result == "failed":
+                    continue  # unplayable entry: not queued, try the next one
+                starting = False
+            q = player.queue
+            q.append(track)
+            if len(q) == 1:
+                schedule_prefetch(player)
+            if job["added"] <= PLAYLIST_RESOLVE_AHEAD:
+                resolvers.append(loop.create_task(_resolve_ahead(sem, track, player.guild.id)))
+            if now_time() - last_edit >= PLAYLIST_PROGRESS_EVERY:
+                last_edit = now_time()
+                try:
+                    await status.edit(content=f"📥 Wczytywanie playlisty: {job['added']} utworów...")
+                except discord.HTTPException:
+                    pass
+        if timed_out:
+            await status.edit(content=f"⌛ Przekroczono czas wczytywania playlisty, dodano {job['added']} utworów.")
+        elif job["added"]:
+            await status.edit(content=f"➕ Dodano {job['added']} utworów z playlisty do kolejki.")
         else:
-            url,title = item[0], item[1]; web=thumb=None; dur=None
-        await start_playback(ctx, url, title, web, thumb, dur, start_offset=0.0)
+            await status.edit(content="❌ Nie udało się pobrać playlisty lub jest pusta.")
+    except asyncio.CancelledError:
+        job["cancel"].set()
+        for t in resolvers:
+            t.cancel()
+        try:
+            await status.edit(content=f"⏹ Wczytywanie playlisty przerwane ({job['added']} utworów).")
+        except Exception:
+            pass
+    finally:
+        if player.playlist_job is job:
+            player.playlist_job = None
+
+# -----------------------
+# Persistent state: one JSON snapshot per guild in SQLite, so a restart resumes every guild where it was
+# -----------------------
+STATE_DB = os.getenv("STATE_DB", "state.db")           # empty disables persistence
+STATE_FLUSH_EVERY = 5.0                                # seconds between writes of changed guilds
+STATE_POSITION_EVERY = 15.0                            # playing guilds are re-saved this often for the position
+STATE_RESTORE_CONCURRENCY = int(os.getenv("STATE_RESTORE_CONCURRENCY", "8"))
+
+class StateStore:
+    """guild_state table (guild_id, data, updated). Blocking methods run in io_pool."""
+    def __init__(self, path):
+        self.path = path
+        self.dirty = set()   # guild ids to (re)write, or delete when the player is gone
+        self.saved = {}      # guild id -> time.time() of the last write
+        self.closing = False
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _db(self):
+        if self.conn is None:
+            # timeout: worker processes of the launcher share the file
+            self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS guild_state "
+                              "(guild_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+        return self.conn
+
+    def write(self, rows, deleted):
+        with self.lock, self._db() as db:
+            db.executemany("INSERT OR REPLACE INTO guild_state VALUES (?, ?, ?)", rows)
+            db.executemany("DELETE FROM guild_state WHERE guild_id = ?", [(gid,) for gid in deleted])
+
+    def load(self):
+        with self.lock:
+            return [(gid, json.loads(data)) for gid, data in self._db().execute("SELECT guild_id, data FROM guild_state")]
+
+    def mark(self, player):
+        if self.path:
+            self.dirty.add(player.guild.id)
+
+    def forget(self, gid):
+        self.saved.pop(gid, None)
+        if self.path and not self.closing:
+            self.dirty.add(gid)  # no player anymore -> row is deleted on the next flush
+
+state_store = StateStore(STATE_DB)
+def mark_dirty(player):
+    """Something about the guild's playback changed: persist it on the next flush, refresh its panel."""
+    state_store.mark(player)
+    touch_panel(player)
+
+def track_to_dict(track):
+    # stream urls expire, they are resolved again on restore
+    return {"id": track.id, "title": track.title, "webpage": track.webpage, "thumb": track.thumb,
+            "duration": track.duration, "acodec": track.acodec}
+
+def snapshot(player):
+    v = player.guild.voice_client
+    return {
+        "voice": v.channel.id if v and v.channel else None,
+        "text": player.channel.id if player.channel else None,
+        "current": track_to_dict(player.current) if player.current else None,
+        "position": get_play_position(player),
+        "paused": bool(v and v.is_paused()),
+        "queue": [track_to_dict(t) for t in player.queue],
+        "filter": player.filter,
+        "bass": player.bass,
+        "volume": player.volume,
+        "loop": player.loop_mode,
+        "autoplay": player.autoplay,
+    }
+
+async def flush_state(everything=False):
+    """Write dirty guilds (+ playing ones whose saved position got old; all of them with everything=True)."""
+    if not state_store.path:
+        return
+    now = time.time()
+    gids = set(state_store.dirty)
+    state_store.dirty.clear()
+    for gid, player in players.items():
+        v = player.guild.voice_client
+        if everything or (player.current and v and v.is_playing()
+                          and now - state_store.saved.get(gid, 0) >= STATE_POSITION_EVERY):
+            gids.add(gid)
+    if not gids:
         return
-    if autoplay.get(gid, False):
-        info = current_song.get(gid)
-        if info and info.get("title"):
-            title = info["title"]
+    rows, deleted = [], []
+    for gid in gids:
+        player = players.get(gid)
+        if player is None:
+            deleted.append(gid)
+            continue
+        rows.append((gid, json.dumps(snapshot(player)), now))
+        state_store.saved[gid] = now
+    await asyncio.get_running_loop().run_in_executor(io_pool, state_store.write, rows, deleted)
+
+async def state_flusher():
+    while True:
+        await asyncio.sleep(STATE_FLUSH_EVERY)
+        try:
+            await flush_state()
+        except Exception as e:
+            report_error("state_flush", e)
+
+async def restore_guild(sem, gid, data):
+    async with sem:
+        guild = bot.get_guild(gid)
+        channel = guild.get_channel(data["voice"]) if guild and data.get("voice") else None
+        # nobody left to listen (or the channel is gone) -> drop the snapshot instead of rejoining
+        if channel is None or not data.get("current") or not any(not m.bot for m in channel.members):
+            state_store.dirty.add(gid)
+            return
+        player = get_player(guild)
+        player.channel = guild.get_channel(data["text"]) if data.get("text") else None
+        player.filter = data.get("filter")
+        player.bass = data.get("bass", 0)
+        player.volume = data.get("volume", 1.0)
+        player.loop_mode = data.get("loop", 0)
+        player.autoplay = data.get("autoplay", False)
+        player.queue.extend(Track(**t) for t in data.get("queue", []))
+        track = Track(**data["current"])
+        pos = float(data.get("position") or 0.0)
+        try:
+            await channel.connect()
+        except Exception as e:
+            report_error("restore_connect", e)
+            release_player(gid)
+            return
+        # through the guild's consumer like every other start, so a !play arriving meanwhile is not cut off
+        player.current = track
+        try:
+            started = await _request(player, "restarted", track, pos, False)
+        except Saturated:
+            started = None
+        if players.get(gid) is not player:
+            return  # stopped / left meanwhile
+        if started:
+            if data.get("paused"):
+                guild.voice_client.pause()
+        elif player.current is not track:
+            player.queue.appendleft(track)  # a command started another track first: the restored one is next
+        else:
+            # saturated: back to the head of the queue (loop mode replays current anyway) and the idle
+            # player retries it with the usual back-off; unplayable: the queue simply moves on
+            if started is None and player.loop_mode != 1:
+                player.queue.appendleft(track)
+            post_event(player, "ended", player.generation, None, 0, None)
+        if player.channel and player.current:
             try:
-                with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                    data = ydl.extract_info(f"ytsearch5:{title}", download=False)
-                chosen = None
-                if data and "entries" in data:
-                    for entry in data["entries"]:
-                        if not entry: continue
-                        t = entry.get("title","")
-                        if t and t != title:
-                            sub = fetch_info(entry.get("webpage_url") or entry.get("id") or entry.get("url"))
-                            if sub:
-                                chosen = sub
-                                break
-                if chosen:
-                    url,title,web,thumb,dur = chosen
-                    await start_playback(ctx, url,title,web,thumb,dur, start_offset=0.0)
-                    return
-            except Exception:
+                await player.channel.send(f"♻️ Wznowiono po restarcie: **{player.current.title}**")
+            except discord.HTTPException:
                 pass
-    # nothing next -> leave bot in VC, keep current_song
+
+async def restore_state():
+    """Runs once in the background after on_ready; guilds are restored in parallel (bounded)."""
+    if not state_store.path:
+        return
+    try:
+        rows = await asyncio.get_running_loop().run_in_executor(io_pool, state_store.load)
+    except Exception as e:
+        report_error("state_restore", e)
+        rows = []
+    bot.loop.create_task(state_flusher())
+    sem = asyncio.Semaphore(STATE_RESTORE_CONCURRENCY)
+    # rows of guilds on other processes' shards are left alone
+    await asyncio.gather(*(restore_guild(sem, gid, data) for gid, data in rows if owns_guild(gid)),
+                         return_exceptions=True)
 
 # -----------------------
 # Buttons: PlayerView (only created by play/np)
 # -----------------------
 class PlayerView(discord.ui.View):
-    def __init__(self, gid, ctx, *, timeout=180.0):
-        super().__init__(timeout=timeout)
-        self.gid = gid
-        self.ctx = ctx
+    """One persistent instance (no timeout, fixed custom_ids, registered with bot.add_view) serves the
+    panels of every guild, also the ones sent before a restart; buttons act on the guild's live player."""
+    def __init__(self):
+        super().__init__(timeout=None)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         guild = interaction.guild
@@ -277,109 +2467,174 @@ class PlayerView(discord.ui.View):
         if member is None or not member.voice or member.voice.channel != vc.channel:
             await interaction.response.send_message("Musisz być na tym samym kanale głosowym, aby sterować.", ephemeral=True)
             return False
+        player = get_player(guild)
+        if player.channel is None:
+            player.channel = interaction.channel
         return True
 
-    @discord.ui.button(label="⏯️", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="⏯️", style=discord.ButtonStyle.secondary, custom_id="m4:playpause")
     async def playpause(self, interaction: discord.Interaction, button: discord.ui.Button):
         v = interaction.guild.voice_client
         if not v:
             await interaction.response.send_message("❌ Bot nie jest połączony.", ephemeral=True); return
         if v.is_playing():
-            v.pause(); await interaction.response.send_message("⏸ Wstrzymano.", ephemeral=True)
+            v.pause(); mark_dirty(get_player(interaction.guild)); await interaction.response.send_message("⏸ Wstrzymano.", ephemeral=True)
         elif v.is_paused():
-            v.resume(); await interaction.response.send_message("▶ Wznowiono.", ephemeral=True)
+            v.resume(); mark_dirty(get_player(interaction.guild)); await interaction.response.send_message("▶ Wznowiono.", ephemeral=True)
         else:
             await interaction.response.send_message("❌ Nic nie gra.", ephemeral=True)
 
-    @discord.ui.button(label="⏭️", style=discord.ButtonStyle.primary)
+    @discord.ui.button(label="⏭️", style=discord.ButtonStyle.primary, custom_id="m4:skip")
     async def skip(self, interaction: discord.Interaction, button: discord.ui.Button):
         v = interaction.guild.voice_client
         if not v or not v.is_playing():
             await interaction.response.send_message("❌ Nic nie gra.", ephemeral=True); return
-        v.stop(); await interaction.response.send_message("⏭ Pominięto.", ephemeral=False)
+        request_skip(get_player(interaction.guild)); await interaction.response.send_message("⏭ Pominięto.", ephemeral=False)
 
-    @discord.ui.button(label="⏮️", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="⏮️", style=discord.ButtonStyle.secondary, custom_id="m4:replay")
     async def replay(self, interaction: discord.Interaction, button: discord.ui.Button):
-        info = current_song.get(interaction.guild.id)
+        player = get_player(interaction.guild)
+        info = player.current
         if not info:
             await interaction.response.send_message("❌ Nic nie gra.", ephemeral=True); return
-        suppress_after[interaction.guild.id] = True
-        v = interaction.guild.voice_client
-        if v: v.stop()
-        await start_playback(self.ctx, info["url"], info["title"], info.get("webpage"), info.get("thumb"), info.get("duration"), start_offset=0.0)
+        try:
+            await request_restart(player, 0.0, send_np=True)
+        except Saturated:
+            return await interaction.response.send_message(SATURATED_MSG, ephemeral=True)
         await interaction.response.send_message("⏮ Odtwarzam od początku.", ephemeral=False)
 
-    @discord.ui.button(label="🔁", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="🔁", style=discord.ButtonStyle.secondary, custom_id="m4:loop_btn")
     async def loop_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        gid = interaction.guild.id
-        cur = loop_mode.get(gid,0); cur = (cur + 1) % 3; loop_mode[gid] = cur
+        player = get_player(interaction.guild)
+        player.loop_mode = (player.loop_mode + 1) % 3
+        schedule_prefetch(player)
+        cur = player.loop_mode
         txt = "off" if cur==0 else ("single" if cur==1 else "queue")
         await interaction.response.send_message(f"🔁 Loop: {txt}", ephemeral=False)
 
-    @discord.ui.button(label="🔀", style=discord.ButtonStyle.secondary)
+    @discord.ui.button(label="🔀", style=discord.ButtonStyle.secondary, custom_id="m4:shuffle_btn")
     async def shuffle_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        random.shuffle(get_queue(interaction.guild.id))
+        player = get_player(interaction.guild)
+        random.shuffle(player.queue)
+        schedule_prefetch(player)
         await interaction.response.send_message("🔀 Kolejka wymieszana.", ephemeral=False)
 
-    @discord.ui.button(label="🔊+", style=discord.ButtonStyle.success)
+    @discord.ui.button(label="🔊+", style=discord.ButtonStyle.success, custom_id="m4:vol_up")
     async def vol_up(self, interaction: discord.Interaction, button: discord.ui.Button):
-        gid = interaction.guild.id
-        volumes[gid] = min(2.0, volumes.get(gid,1.0) + 0.1)
-        await interaction.response.send_message(f"🔊 Głośność: {int(volumes[gid]*100)}%", ephemeral=True)
-        info = current_song.get(gid)
-        if info:
-            suppress_after[gid] = True
-            v = interaction.guild.voice_client
-            if v: v.stop()
-            await start_playback(self.ctx, info["url"], info["title"], info.get("webpage"), info.get("thumb"), info.get("duration"), start_offset=int(get_play_position(gid)), send_np=False)
-
-    @discord.ui.button(label="🔈-", style=discord.ButtonStyle.danger)
+        player = get_player(interaction.guild)
+        player.volume = min(2.0, player.volume + 0.1)
+        await interaction.response.send_message(f"🔊 Głośność: {int(player.volume*100)}%", ephemeral=True)
+        request_apply(player)
+
+    @discord.ui.button(label="🔈-", style=discord.ButtonStyle.danger, custom_id="m4:vol_down")
     async def vol_down(self, interaction: discord.Interaction, button: discord.ui.Button):
-        gid = interaction.guild.id
-        volumes[gid] = max(0.05, volumes.get(gid,1.0) - 0.1)
-        await interaction.response.send_message(f"🔉 Głośność: {int(volumes[gid]*100)}%", ephemeral=True)
-        info = current_song.get(gid)
-        if info:
-            suppress_after[gid] = True
-            v = interaction.guild.voice_client
-            if v: v.stop()
-            await start_playback(self.ctx, info["url"], info["title"], info.get("webpage"), info.get("thumb"), info.get("duration"), start_offset=int(get_play_position(gid)), send_np=False)
-
-    @discord.ui.button(label="⏹️", style=discord.ButtonStyle.danger)
+        player = get_player(interaction.guild)
+        player.volume = max(0.05, player.volume - 0.1)
+        await interaction.response.send_message(f"🔉 Głośność: {int(player.volume*100)}%", ephemeral=True)
+        request_apply(player)
+
+    @discord.ui.button(label="⏹️", style=discord.ButtonStyle.danger, custom_id="m4:stop_btn")
     async def stop_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        gid = interaction.guild.id
-        queues[gid] = []
-        filters.pop(gid, None)
-        bass_gain.pop(gid, None)
-        current_song.pop(gid, None)
-        suppress_after[gid] = True
+        release_player(interaction.guild.id)
         v = interaction.guild.voice_client
         if v:
             v.stop(); await v.disconnect()
         await interaction.response.send_message("⏹ Zatrzymano i rozłączono.", ephemeral=False)
 
 # -----------------------
-# Now playing (embed + buttons)
+# Now playing panel: one message per guild, edited in place. A single scheduler spends a global
+# budget of PANEL_EDITS_PER_SECOND across all guilds (oldest request first) and skips edits that
+# would not change what the panel shows
 # -----------------------
-async def send_now_playing(ctx, gid):
-    info = current_song.get(gid)
-    if not info:
-        return
-    title = info["title"]
-    pos = int(get_play_position(gid))
-    dur = info.get("duration")
+PANEL_REFRESH = float(os.getenv("PANEL_REFRESH", "15"))  # progress bar refresh of a playing guild (s)
+PANEL_EDITS_PER_SECOND = float(os.getenv("PANEL_EDITS_PER_SECOND", "4"))
+PANEL_NEAR_MESSAGES = 10  # !np moves the panel down only when at least this many messages are below it
+
+player_view = None  # the persistent PlayerView, see start_panels
+panel_pending = collections.OrderedDict()  # guild id -> None, panels waiting for an edit
+
+def render_panel(player):
+    info = player.current
+    pos = int(get_play_position(player))
+    dur = info.duration
     if dur:
         frac = min(1.0, pos/dur) if dur>0 else 0
         filled = int(frac*20)
         prog = "[" + "█"*filled + "░"*(20-filled) + f"] {pos}/{dur}s"
     else:
         prog = f"{pos}s"
-    embed = discord.Embed(title="Teraz grane", description=f"**{title}**\n{prog}", color=0x1DB954)
-    if info.get("webpage"): embed.url = info.get("webpage")
-    if info.get("thumb"): embed.set_thumbnail(url=info.get("thumb"))
-    view = PlayerView(gid, ctx)
-    msg = await ctx.send(embed=embed, view=view)
-    control_message[gid] = msg.id
+    embed = discord.Embed(title="Teraz grane", description=f"**{info.title}**\n{prog}", color=0x1DB954)
+    if info.webpage: embed.url = info.webpage
+    if info.thumb: embed.set_thumbnail(url=info.thumb)
+    v = player.guild.voice_client
+    status = ["⏸ pauza" if v and v.is_paused() else "▶ gra" if player.state == "playing" else "⏹ koniec"]
+    status.append(f"🔊 {int(player.volume*100)}%")
+    if player.loop_mode:
+        status.append("🔁 " + ("single" if player.loop_mode == 1 else "queue"))
+    if player.filter:
+        status.append(f"✨ {player.filter}")
+    if player.bass:
+        status.append(f"🎚️ {player.bass} dB")
+    if player.queue:
+        status.append(f"📜 w kolejce {len(player.queue)}")
+    embed.set_footer(text=" · ".join(status))
+    return embed
+
+def touch_panel(player, urgent=False):
+    """Refresh the guild's panel with the next edits (urgent: before every other waiting one)."""
+    if player.control_message is None:
+        return
+    gid = player.guild.id
+    panel_pending[gid] = None
+    if urgent:
+        panel_pending.move_to_end(gid, last=False)
+
+async def send_now_playing(player):
+    """Show the current track: the guild's panel in the announcement channel is edited,
+    a new one is only sent when there is none there yet."""
+    if not player.current or not player.channel:
+        return
+    msg = player.control_message
+    if msg is not None and msg.channel.id == player.channel.id:
+        return touch_panel(player, urgent=True)
+    embed = render_panel(player)
+    player.control_message = await player.channel.send(embed=embed, view=player_view)
+    player.panel_shown = embed.to_dict()
+    player.panel_due = now_time() + PANEL_REFRESH
+
+async def panel_scheduler():
+    while True:
+        if not panel_pending:
+            now = now_time()
+            for gid, player in players.items():
+                if player.control_message is not None and player.state == "playing" and now >= player.panel_due:
+                    panel_pending[gid] = None
+            if not panel_pending:
+                await asyncio.sleep(0.5)
+                continue
+        gid, _ = panel_pending.popitem(last=False)
+        player = players.get(gid)
+        if player is None or player.control_message is None or player.current is None:
+            continue
+        player.panel_due = now_time() + PANEL_REFRESH
+        try:
+            embed = render_panel(player)
+            shown = embed.to_dict()
+            if shown == player.panel_shown:
+                continue  # nothing visible changed, costs no request
+            await player.control_message.edit(embed=embed)
+            player.panel_shown = shown
+        except (discord.NotFound, discord.Forbidden):
+            player.control_message = None  # deleted / no access: the next track sends a new one
+        except Exception as e:
+            report_error("panel_edit", e)  # one bad panel must not stop the others
+        await asyncio.sleep(1.0 / PANEL_EDITS_PER_SECOND)
+
+def start_panels(client):
+    global player_view
+    player_view = PlayerView()
+    client.add_view(player_view)  # buttons of panels sent before a restart keep working
+    client.loop.create_task(panel_scheduler())
 
 # -----------------------
 # Commands
@@ -394,6 +2649,7 @@ async def join(ctx):
 @bot.command()
 async def leave(ctx):
     v = ctx.voice_client
+    release_player(ctx.guild.id)
     if v:
         await v.disconnect(); await ctx.send("👋 Opuszczam kanał.")
     else:
@@ -401,93 +2657,92 @@ async def leave(ctx):
 
 @bot.command()
 async def play(ctx, *, query):
-    res = fetch_info(query)
+    res = await fetch_info_async(query, ctx.guild.id, PRIO_PLAYBACK)
     if not res:
         return await ctx.send("❌ Nie udało się pobrać utworu.")
-    stream_url, title, webpage, thumb, dur = res
-    gid = ctx.guild.id
-    v = ctx.voice_client
-    if v and v.is_playing():
-        get_queue(gid).append((stream_url, title, webpage, thumb, dur))
-        return await ctx.send(f"➕ Dodano do kolejki: **{title}**")
-    await start_playback(ctx, stream_url, title, webpage, thumb, dur, start_offset=0.0, send_np=True)
+    if not await ensure_voice(ctx):
+        return
+    player = player_for(ctx)
+    result = await request_play(player, res)
+    if result == "queued":
+        await ctx.send(f"➕ Dodano do kolejki: **{res.title}**")
+    elif result == "failed":
+        await ctx.send("❌ Nie udało się odtworzyć utworu.")
 
 @bot.command()
 async def playlist(ctx, url):
-    entries = fetch_playlist_entries(url)
-    if not entries:
-        return await ctx.send("❌ Nie udało się pobrać playlisty lub jest pusta.")
-    gid = ctx.guild.id
-    for ent in entries:
-        get_queue(gid).append(ent)
-    await ctx.send(f"➕ Dodano {len(entries)} utworów z playlisty do kolejki.")
+    if not await ensure_voice(ctx):
+        return
+    player = player_for(ctx)
+    cancel_ingest(player)
+    job = {"cancel": threading.Event(), "task": None, "added": 0}
+    job["task"] = asyncio.get_running_loop().create_task(ingest_playlist(player, url, job))
+    player.playlist_job = job
+
+SEARCH_TTL = 600.0   # seconds !select can still pick from the last !search of a guild
+SEARCH_KEEP = 256    # guilds whose results are kept at most (oldest search dropped first)
+search_results = collections.OrderedDict()  # guild id -> (expiry loop time, [Track]); needs no player / voice
 
 @bot.command()
 async def search(ctx, *, query):
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-        data = ydl.extract_info(f"ytsearch5:{query}", download=False)
-    results = []
-    if not data or "entries" not in data:
-        return await ctx.send("❌ Nie znaleziono wyników.")
-    for e in data["entries"]:
-        if not e: continue
-        title = e.get("title","Unknown")
-        webpage = e.get("webpage_url")
-        thumb = e.get("thumbnail")
-        duration = e.get("duration")
-        results.append((title, webpage, thumb, duration))
+    results = await search_entries_async(query, gid=ctx.guild.id)
     if not results:
         return await ctx.send("❌ Nie znaleziono wyników.")
-    search_results[ctx.guild.id] = results
+    search_results.pop(ctx.guild.id, None)
+    search_results[ctx.guild.id] = (now_time() + SEARCH_TTL, results)
+    while len(search_results) > SEARCH_KEEP:
+        search_results.popitem(last=False)
     msg = "**Wyniki wyszukiwania (wybierz !select <nr>):**\n"
-    for i, (title, webpage, thumb, duration) in enumerate(results, start=1):
-        durtxt = f" [{duration}s]" if duration else ""
-        msg += f"{i}. {title}{durtxt}\n"
+    for i, track in enumerate(results, start=1):
+        durtxt = f" [{track.duration}s]" if track.duration else ""
+        msg += f"{i}. {track.title}{durtxt}\n"
     await ctx.send(msg)
 
 @bot.command()
 async def select(ctx, index: int):
-    gid = ctx.guild.id
-    if gid not in search_results:
+    entry = search_results.get(ctx.guild.id)
+    if entry is None or entry[0] < now_time():
+        search_results.pop(ctx.guild.id, None)
         return await ctx.send("❌ Brak aktywnego wyszukiwania. Użyj !search <query>.")
-    arr = search_results[gid]
+    arr = entry[1]
     if not (1 <= index <= len(arr)):
         return await ctx.send("❌ Nieprawidłowy numer.")
-    title, webpage, thumb, duration = arr[index-1]
-    res = fetch_info(webpage or title)
-    if not res:
-        return await ctx.send("❌ Nie udało się pobrać wybranego utworu.")
-    stream_url, title2, webpage2, thumb2, dur2 = res
-    v = ctx.voice_client
-    if v and v.is_playing():
-        get_queue(gid).append((stream_url, title2, webpage2, thumb2, dur2))
-        return await ctx.send(f"➕ Dodano do kolejki: **{title2}**")
-    await start_playback(ctx, stream_url, title2, webpage2, thumb2, dur2, start_offset=0.0, send_np=True)
+    # search results already carry a resolved url; ensure_stream refreshes it if it went stale
+    track = arr[index-1].copy()
+    if not await ensure_voice(ctx):
+        return
+    player = player_for(ctx)
+    result = await request_play(player, track)
+    if result == "queued":
+        await ctx.send(f"➕ Dodano do kolejki: **{track.title}**")
+    elif result == "failed":
+        await ctx.send("❌ Nie udało się pobrać wybranego utworu.")
 
 @bot.command()
 async def skip(ctx):
     v = ctx.voice_client
     if not v or not v.is_playing():
         return await ctx.send("❌ Nic nie gra.")
-    v.stop(); await ctx.send("⏭ Pominięto.")
+    player = players.get(ctx.guild.id)
+    if player:
+        request_skip(player)
+    else:
+        v.stop()
+    await ctx.send("⏭ Pominięto.")
 
 @bot.command()
 async def stop(ctx):
-    gid = ctx.guild.id
-    queues[gid] = []
-    filters.pop(gid, None)
-    bass_gain.pop(gid, None)
-    current_song.pop(gid, None)
+    release_player(ctx.guild.id)
     v = ctx.voice_client
     if v:
-        suppress_after[gid] = True; v.stop(); await v.disconnect()
+        v.stop(); await v.disconnect()
     await ctx.send("🛑 Zatrzymano i rozłączono.")
 
 @bot.command()
 async def pause(ctx):
     v = ctx.voice_client
     if v and v.is_playing():
-        v.pause(); await ctx.send("⏸ Wstrzymano.")
+        v.pause(); mark_dirty(player_for(ctx)); await ctx.send("⏸ Wstrzymano.")
     else:
         await ctx.send("❌ Nic nie gra.")
 
@@ -495,7 +2750,7 @@ async def pause(ctx):
 async def resume(ctx):
     v = ctx.voice_client
     if v and v.is_paused():
-        v.resume(); await ctx.send("▶ Wznowiono.")
+        v.resume(); mark_dirty(player_for(ctx)); await ctx.send("▶ Wznowiono.")
     else:
         await ctx.send("❌ Nie ma pauzy.")
 
@@ -504,16 +2759,15 @@ async def resume(ctx):
 # -----------------------
 @bot.command()
 async def volume(ctx, vol: int = None):
-    gid = ctx.guild.id
     if vol is None:
-        current = int(volumes.get(gid, 1.0) * 100)
+        player = players.get(ctx.guild.id)
+        current = int((player.volume if player else 1.0) * 100)
         return await ctx.send(f"🔊 Aktualna głośność: **{current}%**")
     if vol < 1 or vol > 200:
         return await ctx.send("🔈 Podaj wartość **1–200**.")
-    volumes[gid] = vol / 100
-    v = ctx.voice_client
-    if v and getattr(v, "source", None) and isinstance(v.source, discord.PCMVolumeTransformer):
-        v.source.volume = volumes[gid]
+    player = player_for(ctx)
+    player.volume = vol / 100
+    request_apply(player)
     # confirmation only (no embed refresh)
     await ctx.send(f"🔊 Ustawiono głośność na **{vol}%**.")
 
@@ -535,81 +2789,121 @@ async def seek(ctx, t: str):
     seconds = parse_time_string(t)
     if seconds is None:
         return await ctx.send("Podaj czas w sekundach lub mm:ss")
-    gid = ctx.guild.id
-    if gid not in current_song:
+    player = players.get(ctx.guild.id)
+    if not player or not player.current:
         return await ctx.send("❌ Nic nie gra.")
-    stream_url = current_song[gid]["url"]
-    title = current_song[gid]["title"]
     v = ctx.voice_client
     if not v:
         return await ctx.send("❌ Bot nie jest połączony.")
-    suppress_after[gid] = True
-    v.stop()
-    await start_playback(ctx, stream_url, title, current_song[gid].get("webpage"), current_song[gid].get("thumb"), current_song[gid].get("duration"), start_offset=seconds, send_np=False)
+    player.channel = ctx.channel
+    # inside the ring buffer / read-ahead: move the cursor, ffmpeg keeps running
+    buf = decoder_of(getattr(v, "source", None))
+    if buf is not None and buf.seek(seconds):
+        if isinstance(v.source, DSPSource):
+            v.source.flush()
+        player.start_offset = float(seconds)
+        player.start_time = now_time()
+        schedule_prefetch(player)
+        return await ctx.send(f"⏩ Przewinięto do {t} ({seconds}s).")
+    # otherwise restart with input-side -ss (index based on cached .mka files)
+    if not await request_restart(player, seconds):
+        return await ctx.send("❌ Nie udało się przewinąć.")
     await ctx.send(f"⏩ Przewinięto do {t} ({seconds}s).")
 
 # -----------------------
 # Filters: ON/OFF logic, single main filter at once, bass independent
 # -----------------------
-async def apply_filter_immediate(ctx, gid):
-    if gid not in current_song:
-        return await ctx.send("❌ Nic nie gra.")
-    pos = int(get_play_position(gid))
-    stream_url = current_song[gid]["url"]
-    title = current_song[gid]["title"]
-    v = ctx.voice_client
-    if not v:
-        return await ctx.send("❌ Bot nie jest połączony.")
-    suppress_after[gid] = True
-    v.stop()
-    # restart but DO NOT send embed (confirmation already sent by caller)
-    await start_playback(ctx, stream_url, title, current_song[gid].get("webpage"), current_song[gid].get("thumb"), current_song[gid].get("duration"), start_offset=pos, send_np=False)
+CONTROL_DEBOUNCE = 0.35  # seconds of volume/bass/filter changes collected into one restart
+
+def needs_restart(player, source):
+    """Can the playing source not follow the player's current volume/bass/filter settings?"""
+    if source is None or live_dsp(source):
+        return False  # DSP re-reads the settings every frame
+    if source.is_opus():
+        return not use_passthrough(player)  # passthrough can't scale or filter samples
+    buf = decoder_of(source)
+    # PCMVolumeTransformer (no numpy): gain is live, the rest is ffmpeg's -af chain
+    return buf is not None and buf.af != build_filter_string(player)
+
+def request_apply(player):
+    """Settings on `player` changed. Applied live when possible, otherwise one restart
+    CONTROL_DEBOUNCE after the last of a burst of changes (always with the newest settings)."""
+    mark_dirty(player)
+    v = player.guild.voice_client
+    if not v or not player.current:
+        return
+    source = getattr(v, "source", None)
+    if isinstance(source, discord.PCMVolumeTransformer):
+        source.volume = player.volume
+    player.control_changed = now_time()
+    if player.control_task and not player.control_task.done():
+        return  # the pending task sees this change (debounce window or re-check after its restart)
+    if needs_restart(player, source):
+        player.control_task = asyncio.get_running_loop().create_task(_apply_controls(player))
+
+async def _apply_controls(player):
+    # wait for a quiet CONTROL_DEBOUNCE after the newest change
+    while (wait := player.control_changed + CONTROL_DEBOUNCE - now_time()) > 0:
+        await asyncio.sleep(wait)
+    while players.get(player.guild.id) is player and player.current:
+        v = player.guild.voice_client
+        source = getattr(v, "source", None) if v else None
+        if not needs_restart(player, source):
+            return
+        pos = get_play_position(player)
+        try:
+            # restart but DO NOT send embed (confirmation already sent by the command)
+            if not await request_restart(player, pos):
+                return  # track changed / ended meanwhile
+        except Saturated:
+            if player.channel:
+                await player.channel.send(SATURATED_MSG)
+            return
 
 @bot.command()
 async def bass(ctx, level: int = None):
-    gid = ctx.guild.id
     if level is None:
-        current = bass_gain.get(gid, 0)
+        player = players.get(ctx.guild.id)
+        current = player.bass if player else 0
         return await ctx.send(f"🎚️ Aktualny Bass Boost: **{current} dB**")
     if level < -20 or level > 20:
         return await ctx.send("🎚️ Bass boost: **-20 do +20 dB**.")
-    bass_gain[gid] = level
+    player = player_for(ctx)
+    player.bass = level
     # apply immediately but only confirmation message shown
-    await apply_filter_immediate(ctx, gid)
+    request_apply(player)
     await ctx.send(f"🎵 Zastosowano Bass Boost: **{level} dB**")
 
 @bot.command()
 async def nightcore(ctx):
-    gid = ctx.guild.id
-    cur = filters.get(gid)
-    if cur == "nightcore":
-        filters.pop(gid, None)
+    player = player_for(ctx)
+    if player.filter == "nightcore":
+        player.filter = None
         # remove main filter -> apply (restart from pos)
-        await apply_filter_immediate(ctx, gid)
+        request_apply(player)
         return await ctx.send("✨ Nightcore WYŁĄCZONY.")
     # enable nightcore, disable other main filters (vaporwave / eq)
-    filters[gid] = "nightcore"
-    await apply_filter_immediate(ctx, gid)
+    player.filter = "nightcore"
+    request_apply(player)
     await ctx.send("✨ Nightcore WŁĄCZONY.")
 
 @bot.command()
 async def vaporwave(ctx):
-    gid = ctx.guild.id
-    cur = filters.get(gid)
-    if cur == "vaporwave":
-        filters.pop(gid, None)
-        await apply_filter_immediate(ctx, gid)
+    player = player_for(ctx)
+    if player.filter == "vaporwave":
+        player.filter = None
+        request_apply(player)
         return await ctx.send("🌫️ Vaporwave WYŁĄCZONY.")
-    filters[gid] = "vaporwave"
-    await apply_filter_immediate(ctx, gid)
+    player.filter = "vaporwave"
+    request_apply(player)
     await ctx.send("🌫️ Vaporwave WŁĄCZONY.")
 
 @bot.command()
 async def resetfilter(ctx):
-    gid = ctx.guild.id
-    filters.pop(gid, None)
-    bass_gain.pop(gid, None)
-    await apply_filter_immediate(ctx, gid)
+    player = player_for(ctx)
+    player.filter = None
+    player.bass = 0
+    request_apply(player)
     await ctx.send("❌ Wyłączono wszystkie efekty.")
 
 # -----------------------
@@ -617,60 +2911,138 @@ async def resetfilter(ctx):
 # -----------------------
 @bot.command(name="queue")
 async def queue_cmd(ctx):
-    q = get_queue(ctx.guild.id)
+    player = players.get(ctx.guild.id)
+    q = player.queue if player else ()
     if not q: return await ctx.send("🟦 Kolejka pusta.")
     msg = "**🎵 Kolejka:**\n"
     for i, item in enumerate(q, 1):
-        title = item[1] if len(item)>1 else item[0]
-        msg += f"{i}. {title}\n"
+        msg += f"{i}. {item.title}\n"
     await ctx.send(msg)
 
 @bot.command()
 async def remove(ctx, idx: int):
-    q = get_queue(ctx.guild.id)
+    player = players.get(ctx.guild.id)
+    q = player.queue if player else ()
     if not (1 <= idx <= len(q)): return await ctx.send("❌ Nieprawidłowy numer.")
-    removed = q.pop(idx-1)
-    await ctx.send(f"🗑 Usunięto **{removed[1]}**")
+    removed = q[idx-1]
+    del q[idx-1]
+    schedule_prefetch(player)
+    await ctx.send(f"🗑 Usunięto **{removed.title}**")
 
 @bot.command()
 async def clear(ctx):
-    queues[ctx.guild.id] = []
+    player = players.get(ctx.guild.id)
+    if player:
+        player.queue.clear()
+        cancel_ingest(player)
+        drop_prefetch(player)
+        mark_dirty(player)
     await ctx.send("🧹 Kolejka wyczyszczona.")
 
 @bot.command()
 async def shuffle(ctx):
-    random.shuffle(get_queue(ctx.guild.id))
+    player = players.get(ctx.guild.id)
+    if player:
+        random.shuffle(player.queue)
+        schedule_prefetch(player)
     await ctx.send("🔀 Kolejka wymieszana.")
 
 @bot.command(name="songhistory")
-async def songhistory(ctx):
-    h = get_history(ctx.guild.id)
+async def songhistory(ctx, mode: str = None):
+    gid = ctx.guild.id
+    if mode and mode.lower() in ("top", "most"):
+        top = await asyncio.get_running_loop().run_in_executor(io_pool, history_log.most_played, gid, 10)
+        if not top: return await ctx.send("Historia pusta.")
+        return await ctx.send("🏆 Najczęściej grane:\n" + "\n".join(f"{c}× {t}" for c, t in top))
+    player = players.get(gid)
+    if player:
+        await load_history(player)
+        h = list(player.history)[-10:]
+    else:  # no player -> read the log only, don't create state for an idle guild
+        h = await asyncio.get_running_loop().run_in_executor(io_pool, history_log.read, gid, 10)
     if not h: return await ctx.send("Historia pusta.")
-    await ctx.send("📜 Ostatnie utwory:\n" + "\n".join(h[-10:]))
+    lines = [f"`{time.strftime('%d.%m %H:%M', time.localtime(e.ts))}` {e.title}" for e in reversed(h)]
+    await ctx.send("📜 Ostatnie utwory:\n" + "\n".join(lines))
 
 # -----------------------
 # Now playing & help
 # -----------------------
-@bot.command()
-async def np(ctx):
-    gid = ctx.guild.id
-    info = current_song.get(gid)
-    if not info:
+@bot.command(name="np")
+async def np_cmd(ctx):
+    player = players.get(ctx.guild.id)
+    if not player or not player.current:
         return await ctx.send("❌ Nic nie gra.")
-    # wyświetl embed + przyciski bez restartu źródła
-    await send_now_playing(ctx, gid)
+    player.channel = ctx.channel
+    msg = player.control_message
+    if msg is not None and msg.channel.id == ctx.channel.id:
+        # counted from the message cache, no request; a panel still in view is just refreshed
+        below = sum(1 for m in bot.cached_messages if m.channel.id == msg.channel.id and m.id > msg.id)
+        if below < PANEL_NEAR_MESSAGES:
+            return touch_panel(player, urgent=True)
+    # missing, in another channel or scrolled far up -> move it down (the old one would stay frozen)
+    player.control_message = None
+    if msg is not None:
+        try:
+            await msg.delete()
+        except discord.HTTPException:
+            pass
+    await send_now_playing(player)
+
+@bot.command()
+async def cachestats(ctx):
+    m = metadata_cache.stats
+    total = m["hits"] + m["misses"] + m["coalesced"]
+    ratio = (m["hits"] + m["coalesced"]) / total * 100 if total else 0.0
+    a = audio_cache.stats
+    await ctx.send(
+        f"🗂️ Metadane: {len(metadata_cache.entries)}/{metadata_cache.size} wpisów, "
+        f"hit {m['hits']} / coalesced {m['coalesced']} / miss {m['misses']} ({ratio:.0f}%), evict {m['evictions']}\n"
+        f"💾 Audio: {len(audio_cache.entries)} plików, {audio_cache.bytes // (1024*1024)}/{audio_cache.max_bytes // (1024*1024)} MB, "
+        f"hit {a['hits']} / miss {a['misses']}, zapisane {a['stores']}, evict {a['evictions']}")
 
+@bot.command()
+async def audiostats(ctx):
+    f = fanout_stats
+    lines = [f"🔀 Wspólne dekodery: otwarte {f['decoders']}, dołączenia {f['joins']}, "
+             f"przejścia na prywatny {f['fallbacks']}, przyjmujące teraz {len(shared_decoders)}"]
+    for adm in (decoder_slots, extract_slots):
+        st = adm.stats
+        lines.append(f"🚦 {adm.name.capitalize()}: {adm.in_use}/{adm.limit} (max {adm.per_guild}/serwer), "
+                     f"czeka {adm.n_waiting}, przyjęte {st['granted']}, w kolejce {st['queued']}, odrzucone {st['rejected']}")
+    if AUDIO_WORKERS <= 0:
+        lines.append("🎛️ Procesy audio wyłączone (AUDIO_WORKERS=0).")
+    else:
+        alive = [w for w in audio_workers if w.proc.is_alive()]
+        pipes = sum(len(w.pipelines) for w in alive)
+        lines.append(f"🎛️ Procesy audio: {len(alive)}/{AUDIO_WORKERS}, potoki {pipes}")
+        st = frame_stats.summary()
+        if st:
+            lines.append(f"Ramki {st['frames']}, oczekiwania {st['stalls']}, opóźnienie śr {st['mean']*1000:.2f} ms / "
+                         f"p50 {st['p50']*1000:.2f} / p99 {st['p99']*1000:.2f} / max {st['max']*1000:.2f} ms")
+    bufs = [b for b in (decoder_of(getattr(p.guild.voice_client, "source", None)) for p in players.values()
+                        if p.guild.voice_client) if b is not None and b.jitter]
+    j = jitter_stats
+    if bufs:
+        lines.append(f"🪣 Bufory odczytu: {len(bufs)}, zapełnienie śr {sum(b.fill for b in bufs) / len(bufs):.0f} "
+                     f"(min {min(b.fill for b in bufs)}) / cel śr {sum(b.target for b in bufs) / len(bufs):.0f} ramek")
+    lines.append(f"Niedobory ramek {j['underruns']} (bufor powiększony {j['grown']}x, zmniejszony {j['shrunk']}x)")
+    r = recovery_stats
+    if r["recovered"] or r["failed"]:
+        mean = r["latency_total"] / r["recovered"] if r["recovered"] else 0.0
+        lines.append(f"🩹 Wznowienia strumienia: udane {r['recovered']} (śr {mean:.2f} s, max {r['latency_max']:.2f} s), "
+                     f"nieudane {r['failed']}")
+    await ctx.send("\n".join(lines))
 
 @bot.command()
 async def help(ctx):
-    txt = """🎵 **LISTA KOMEND MUZYCZNYCH 3.1 (PCM SIMPLE)** 🎵
+    txt = """🎵 **LISTA KOMEND MUZYCZNYCH 3.2** 🎵
 
 !join / !leave
 !play <nazwa/link>
 !playlist <yt_playlist_link>
 !search <query> -> !select <nr>
 !skip / !stop / !pause / !resume / !seek <mm:ss lub ss>
-!queue / !remove <nr> / !clear / !shuffle / !songhistory / !np
+!queue / !remove <nr> / !clear / !shuffle / !songhistory [top] / !np
 
 Efekty (ON/OFF):
 !bass <db> (independent)
@@ -683,6 +3055,8 @@ Volume:
 
 Loop: !loop off|single|queue
 Autoplay: !autoplay_cmd on/off
+
+Statystyki: !cachestats / !audiostats
 """
     await ctx.send(txt)
 
@@ -691,40 +3065,197 @@ Autoplay: !autoplay_cmd on/off
 # -----------------------
 @bot.command()
 async def loop(ctx, mode: str = None):
-    gid = ctx.guild.id
     if mode is None:
-        cur = loop_mode.get(gid,0); await ctx.send(f"🔁 Tryb loop: {cur} (0=off,1=single,2=queue)"); return
+        player = players.get(ctx.guild.id)
+        cur = player.loop_mode if player else 0
+        await ctx.send(f"🔁 Tryb loop: {cur} (0=off,1=single,2=queue)"); return
+    player = player_for(ctx)
     m = mode.lower()
-    if m in ("off","0"): loop_mode[gid] = 0
-    elif m in ("single","1"): loop_mode[gid] = 1
-    elif m in ("queue","2"): loop_mode[gid] = 2
+    if m in ("off","0"): player.loop_mode = 0
+    elif m in ("single","1"): player.loop_mode = 1
+    elif m in ("queue","2"): player.loop_mode = 2
     else: return await ctx.send("Użyj: off/single/queue")
-    await ctx.send(f"🔁 Ustawiono loop: {loop_mode[gid]}")
+    schedule_prefetch(player)
+    await ctx.send(f"🔁 Ustawiono loop: {player.loop_mode}")
 
 @bot.command()
 async def autoplay_cmd(ctx, mode: str):
-    gid = ctx.guild.id
-    if mode.lower() in ("on","true","1"): autoplay[gid] = True; await ctx.send("🔁 Autoplay włączony.")
-    else: autoplay[gid] = False; await ctx.send("🔁 Autoplay wyłączony.")
+    player = player_for(ctx)
+    if mode.lower() in ("on","true","1"): player.autoplay = True; await ctx.send("🔁 Autoplay włączony.")
+    else: player.autoplay = False; await ctx.send("🔁 Autoplay wyłączony.")
+    schedule_prefetch(player)
 
 # -----------------------
-# On ready
+# Metrics endpoint: runtime gauges, event-loop lag, per-command latency
 # -----------------------
-@bot.event
-async def on_ready():
-    print(f"Zalogowano jako {bot.user} (Music Bot v3.1 PCM SIMPLE)")
+LOOP_LAG_INTERVAL = 0.5
+loop_lag = 0.0  # last measured oversleep of the event loop (s)
+
+@metrics.collector
+def runtime_metrics():
+    playing = sum(1 for p in players.values() if p.state == "playing")
+    out = [("m4_players", "gauge", {}, len(players)), ("m4_players_playing", "gauge", {}, playing),
+           ("m4_event_loop_lag_last_seconds", "gauge", {}, f"{loop_lag:.6f}"),
+           ("m4_shared_decoders_open", "gauge", {}, len(shared_decoders)),
+           ("m4_audio_worker_pipelines", "gauge", {}, sum(len(w.pipelines) for w in audio_workers)),
+           ("m4_frame_underruns_total", "counter", {}, jitter_stats["underruns"]),
+           ("m4_jitter_resizes_total", "counter", {"direction": "grow"}, jitter_stats["grown"]),
+           ("m4_jitter_resizes_total", "counter", {"direction": "shrink"}, jitter_stats["shrunk"]),
+           ("m4_worker_frame_stalls_total", "counter", {}, frame_stats.stalls)]
+    for adm in (decoder_slots, extract_slots):
+        # decoder slots == live ffmpeg processes of this bot process
+        out.append(("m4_admission_in_use", "gauge", {"pool": adm.name}, adm.in_use))
+        out.append(("m4_admission_waiting", "gauge", {"pool": adm.name}, adm.n_waiting))
+        for k, v in adm.stats.items():
+            out.append(("m4_admission_total", "counter", {"pool": adm.name, "outcome": k}, v))
+    for k, v in fanout_stats.items():
+        out.append(("m4_fanout_total", "counter", {"event": k}, v))
+    for k in ("recovered", "failed"):
+        out.append(("m4_stream_recoveries_total", "counter", {"outcome": k}, recovery_stats[k]))
+    for name, cache in (("metadata", metadata_cache), ("related", related_cache), ("audio", audio_cache)):
+        for k, v in cache.stats.items():
+            out.append(("m4_cache_total", "counter", {"cache": name, "event": k}, v))
+    return out
+
+async def watch_loop_lag():
+    global loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        metrics.observe("m4_event_loop_lag_seconds", loop_lag)
+
+async def _serve_metrics(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)  # any path, any method
+        body = metrics.render().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass  # scraper went away / sent garbage
+    finally:
+        writer.close()
+
+async def start_metrics():
+    asyncio.get_running_loop().create_task(watch_loop_lag())
+    if METRICS_PORT:
+        await asyncio.start_server(_serve_metrics, METRICS_HOST, METRICS_PORT)
+        print(f"Metryki: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+@bot.before_invoke
+async def _command_started(ctx):
+    ctx.started = time.perf_counter()
+
+@bot.after_invoke
+async def _command_finished(ctx):
+    # runs after failed commands too
+    metrics.observe("m4_command_seconds", time.perf_counter() - ctx.started, command=ctx.command.qualified_name)
+
+@bot.command(name="metrics")
+@commands.is_owner()
+async def metrics_cmd(ctx):
+    await ctx.send(file=discord.File(io.BytesIO(metrics.render().encode()), "metrics.txt"))
 
 # -----------------------
-# Run
+# Events: ready, player lifecycle
 # -----------------------
-import os
+@bot.event
+async def on_command_error(ctx, error):
+    metrics.inc("m4_command_errors_total", command=ctx.command.qualified_name if ctx.command else "",
+                error=type(getattr(error, "original", error)).__name__)
+    if isinstance(getattr(error, "original", error), Saturated):
+        return await ctx.send(SATURATED_MSG)
+    if isinstance(error, commands.NotOwner):
+        return await ctx.send("❌ Tylko właściciel bota może użyć tej komendy.")
+    await commands.Bot.on_command_error(bot, ctx, error)
 
-TOKEN = os.getenv("DISCORD_TOKEN")
-bot.run(TOKEN)
+state_restored = False
 
+@bot.event
+async def on_ready():
+    global state_restored
+    warm_extractors()
+    warm_audio_workers()
+    if not state_restored:  # on_ready fires again after gateway reconnects
+        state_restored = True
+        bot.loop.create_task(restore_state())
+    print(f"Zalogowano jako {bot.user} (Music Bot v3.2), shardy {bot.shard_ids or 'auto'}/{bot.shard_count}")
 
+@bot.event
+async def on_voice_state_update(member, before, after):
+    # bot left / was kicked from voice -> nothing of this guild's player is needed anymore
+    if member.id == bot.user.id and before.channel is not None and after.channel is None:
+        release_player(member.guild.id)
 
+@bot.event
+async def on_guild_remove(guild):
+    release_player(guild.id)
 
+# -----------------------
+# Run: one process, or WORKER_PROCESSES > 1 -> launcher splitting the shards across worker processes
+# -----------------------
+TOKEN = os.getenv("DISCORD_TOKEN")
 
+WORKER_RESTART_DELAY = 10.0  # seconds; a worker that dies sooner than this after start is restarted after a pause
+
+def recommended_shards(token):
+    import urllib.request
+    req = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                 headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot"})
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return int(json.load(resp)["shards"])
+
+def launch_workers(processes):
+    shard_count = SHARD_COUNT or recommended_shards(TOKEN)
+    processes = max(1, min(processes, shard_count))
+    groups = [list(range(i, shard_count, processes)) for i in range(processes)]
+    print(f"Launcher: {shard_count} shardów w {processes} procesach")
+
+    def spawn(i):
+        env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=",".join(map(str, groups[i])),
+                   WORKER_PROCESSES="1")
+        if METRICS_PORT:
+            env["METRICS_PORT"] = str(METRICS_PORT + i)  # one endpoint per worker
+        # each worker owns a subdirectory and its share of the disk budget, nobody evicts another's files
+        env["AUDIO_CACHE_DIR"] = os.path.join(CACHE_DIR, f"w{i}")
+        env["AUDIO_CACHE_MB"] = str(CACHE_MAX_BYTES / processes / (1024 * 1024))
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env), time.time()
+
+    workers = [spawn(i) for i in range(processes)]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for proc, _ in workers:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGINT)  # bot.run() shuts down cleanly (final state flush)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopping:
+        for i, (proc, started) in enumerate(workers):
+            if proc.poll() is None:
+                continue
+            print(f"Launcher: worker {i} (shardy {groups[i]}) zakończył się kodem {proc.returncode}")
+            if time.time() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            if not stopping:
+                workers[i] = spawn(i)
+        time.sleep(1)
+    for proc, _ in workers:
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
 
+def main():
+    if WORKER_PROCESSES > 1 and SHARD_IDS is None:
+        launch_workers(WORKER_PROCESSES)
+    else:
+        bot.run(TOKEN)
 
+if __name__ == "__main__":
+    main()
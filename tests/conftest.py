@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# m4 reads its configuration at import time: no state db, history / cache in a scratch dir
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("STATE_DB", "")
+os.environ.setdefault("HISTORY_DIR", os.path.join(_tmp, "history"))
+os.environ.setdefault("AUDIO_CACHE_DIR", os.path.join(_tmp, "audio_cache"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
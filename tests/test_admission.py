@@ -0,0 +1,37 @@
+import asyncio
+
+import m4
+
+
+def test_guild_at_cap_does_not_block_others():
+    async def scenario():
+        slots = m4.Admission("t", 10, 1)
+        a1 = await slots.acquire(gid=1)
+        a2 = asyncio.ensure_future(slots.acquire(gid=1))  # over guild 1's cap -> waits
+        await asyncio.sleep(0)
+        assert slots.n_waiting == 1
+        b1 = await asyncio.wait_for(slots.acquire(gid=2), 1)
+        assert slots.in_use == 2 and slots.by_guild[2] == 1
+        assert not a2.done()
+        a1.release()
+        a2 = await asyncio.wait_for(a2, 1)
+        assert slots.by_guild[1] == 1 and slots.n_waiting == 0
+        a2.release()
+        b1.release()
+        assert slots.in_use == 0 and not slots.by_guild
+
+    asyncio.run(scenario())
+
+
+def test_disowned_slot_stops_counting_for_guild():
+    async def scenario():
+        slots = m4.Admission("t", 10, 1)
+        slot = await slots.acquire(gid=1)
+        slot.disown()
+        assert slots.in_use == 1 and not slots.by_guild
+        again = await asyncio.wait_for(slots.acquire(gid=1), 1)
+        again.release()
+        slot.release()
+        assert slots.in_use == 0 and not slots.by_guild
+
+    asyncio.run(scenario())
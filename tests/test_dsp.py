@@ -0,0 +1,45 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+sosfreqz = pytest.importorskip("scipy.signal").sosfreqz
+
+import m4  # noqa: E402
+
+
+def gain_db(sos, f):
+    _, h = sosfreqz(sos, worN=[f], fs=m4.DSP_RATE)
+    return 20 * np.log10(abs(h[0]))
+
+
+def test_no_filters_is_passthrough():
+    assert m4.dsp_chain(1.0, 0, None) == (None, 1.0, 1.0)
+    sos, gain, speed = m4.dsp_chain(0.5, 0, None)
+    assert sos is None and gain == 0.5 and speed == 1.0
+
+
+def test_bass_shelf_gain():
+    for g in (8, -6):
+        sos, _, _ = m4.dsp_chain(1.0, g, None)
+        assert sos.shape == (1, 6)
+        assert abs(gain_db(sos, 20) - g) < 0.5   # full boost / cut well below the 100 Hz shelf
+        assert abs(gain_db(sos, 10000)) < 0.1    # highs untouched
+
+
+def test_eq_preset_peaks_at_its_bands():
+    sos, _, _ = m4.dsp_chain(1.0, 0, "eq:rock")  # +4 dB @ 60 Hz, +3 dB @ 170 Hz
+    assert sos.shape == (2, 6)
+    assert np.allclose(sos[:, 3], 1.0)  # normalized a0
+    assert abs(gain_db(sos, 5000)) < 0.1
+    single = m4.dsp_chain(1.0, 0, "eq:jazz")[0]  # +2 dB @ 200 Hz
+    assert abs(gain_db(single, 200) - 2) < 0.05
+
+
+def test_bass_and_boost_preset_stack():
+    sos, _, _ = m4.dsp_chain(1.0, 4, "eq:boost")  # bass=g=8 on top of the 4 dB shelf
+    assert sos.shape == (2, 6)
+    assert abs(gain_db(sos, 20) - 12) < 1.0
+
+
+def test_speed_effects():
+    assert m4.dsp_chain(1.0, 0, "nightcore")[2] == 1.25
+    assert abs(m4.dsp_chain(1.0, 0, "vaporwave")[2] - 44100 * 0.85 / 48000) < 1e-12
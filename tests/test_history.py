@@ -0,0 +1,50 @@
+import m4
+
+
+def log_with(tmp_path, n, title="Song"):
+    log = m4.HistoryLog(str(tmp_path))
+    for i in range(n):
+        log.append(1, m4.PlayEvent(1000.0 + i, f"id{i}", f"{title} {i}"))
+    return log
+
+
+def test_read_returns_events_oldest_first(tmp_path):
+    events = log_with(tmp_path, 5).read(1)
+    assert [e.id for e in events] == ["id0", "id1", "id2", "id3", "id4"]
+    assert events[0].ts == 1000.0 and events[0].title == "Song 0"
+
+
+def test_read_limit_returns_the_newest_tail(tmp_path):
+    log = log_with(tmp_path, 300)
+    events = log.read(1, limit=10)
+    assert [e.id for e in events] == [f"id{i}" for i in range(290, 300)]
+
+
+def test_read_limit_larger_than_log(tmp_path):
+    assert len(log_with(tmp_path, 3).read(1, limit=50)) == 3
+
+
+def test_read_limit_skips_a_line_cut_by_the_tail_window(tmp_path):
+    # long titles: the tail window (limit * 200 bytes) starts inside a line
+    log = log_with(tmp_path, 20, title="x" * 150)
+    events = log.read(1, limit=5)
+    assert [e.id for e in events] == [f"id{i}" for i in range(15, 20)]
+    assert all(e.title.startswith("x" * 150) for e in events)
+
+
+def test_titles_are_kept_on_one_line(tmp_path):
+    log = m4.HistoryLog(str(tmp_path))
+    log.append(7, m4.PlayEvent(1.0, None, "a\tb\nc"))
+    (event,) = log.read(7)
+    assert event.id is None and event.title == "a b c"
+
+
+def test_missing_log_is_empty(tmp_path):
+    assert m4.HistoryLog(str(tmp_path)).read(42, limit=10) == []
+
+
+def test_most_played(tmp_path):
+    log = m4.HistoryLog(str(tmp_path))
+    for ts, vid in enumerate(["a", "b", "a", "c", "a", "b"]):
+        log.append(1, m4.PlayEvent(float(ts), vid, vid.upper()))
+    assert log.most_played(1, 2) == [(3, "A"), (2, "B")]
@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import m4
+
+
+def track(vid, url=None, expires=0):
+    return m4.Track(id=vid, title=vid, webpage=f"https://www.youtube.com/watch?v={vid}", url=url, expires=expires)
+
+
+def test_lookup_key_normalizes_links_and_queries():
+    vid = "dQw4w9WgXcQ"
+    for url in (f"https://www.youtube.com/watch?v={vid}&list=PL1", f"https://youtu.be/{vid}?t=3",
+                f"https://youtube.com/shorts/{vid}", f"  https://www.youtube.com/embed/{vid} "):
+        assert m4.lookup_key(url) == f"id:{vid}"
+    assert m4.lookup_key("https://soundcloud.com/a/b") == "url:https://soundcloud.com/a/b"
+    assert m4.lookup_key("  Never  Gonna\tGive ") == "q:never gonna give"
+
+
+def test_ttl_is_clamped_to_stream_url_expiry():
+    async def scenario():
+        cache = m4.MetadataCache(10, ttl=3600)
+        soon = time.time() + m4.STREAM_URL_MARGIN + 60
+
+        async def load():
+            return track("a", url="https://x/a", expires=soon)
+
+        await cache.lookup("k", load)
+        assert cache.entries["k"][0] == soon - m4.STREAM_URL_MARGIN
+        cache.entries["k"] = (time.time() - 1, cache.entries["k"][1])  # past the clamped expiry
+        assert cache.get("k") is None and "k" not in cache.entries
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_lookups_share_one_load():
+    async def scenario():
+        cache = m4.MetadataCache(10, ttl=60)
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return track("a")
+
+        results = await asyncio.gather(*(cache.lookup("k", load, m4.track_keys) for _ in range(5)))
+        assert len(calls) == 1
+        assert all(r is results[0] for r in results)
+        assert cache.stats == {"hits": 0, "misses": 1, "coalesced": 4, "evictions": 0}
+        # aliases point at the same entry
+        assert cache.get("id:a") is results[0]
+        await cache.lookup("id:a", load)
+        assert len(calls) == 1 and cache.stats["hits"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_load():
+    async def scenario():
+        cache = m4.MetadataCache(10, ttl=60)
+
+        async def load():
+            await asyncio.sleep(0.05)
+            return track("a")
+
+        first = asyncio.ensure_future(cache.lookup("k", load))
+        second = asyncio.ensure_future(cache.lookup("k", load))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert (await second).id == "a"
+
+    asyncio.run(scenario())
+
+
+def test_lru_eviction_keeps_recently_used():
+    cache = m4.MetadataCache(2, ttl=60)
+    later = time.time() + 60
+    cache.put(["a"], 1, later)
+    cache.put(["b"], 2, later)
+    assert cache.get("a") == 1  # a becomes the most recently used
+    cache.put(["c"], 3, later)
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.stats["evictions"] == 1
+
+
+def test_failed_load_is_not_cached():
+    async def scenario():
+        cache = m4.MetadataCache(10, ttl=60)
+
+        async def load():
+            return None
+
+        assert await cache.lookup("k", load) is None
+        assert not cache.entries and not cache.inflight
+
+    asyncio.run(scenario())
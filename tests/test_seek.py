@@ -0,0 +1,64 @@
+import m4
+
+
+class Frames:
+    """Decoder stand-in: frame i is bytes([i]) * 4, then EOF."""
+    def __init__(self, n):
+        self.frames = [bytes([i]) * 4 for i in range(n)]
+
+    def read(self):
+        return self.frames.pop(0) if self.frames else b""
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+def make(n=50, start_offset=0.0, prefill=0):
+    buf = m4.BufferedSource(Frames(n), start_offset=start_offset)
+    buf.jitter = False  # read() straight from the deques, no reader thread
+    if prefill:
+        buf.prefill(prefill)
+    return buf
+
+
+def index_of(frame):
+    return frame[0]
+
+
+def test_seek_back_inside_played_ring():
+    buf = make()
+    for _ in range(10):
+        buf.read()
+    assert buf.seek(0.1)
+    assert buf.position == 0.1
+    assert index_of(buf.read()) == 5
+    assert [index_of(buf.read()) for _ in range(5)] == [6, 7, 8, 9, 10]
+
+
+def test_seek_forward_inside_read_ahead():
+    buf = make(prefill=20)
+    buf.read()
+    assert buf.seek(0.3)
+    assert index_of(buf.read()) == 15
+    assert buf.position == 0.32
+
+
+def test_seek_outside_buffers_needs_a_restart():
+    buf = make(prefill=5)
+    for _ in range(3):
+        buf.read()
+    assert not buf.seek(1.0)  # beyond the read-ahead
+    assert buf.position == 0.06  # unchanged
+    assert index_of(buf.read()) == 3
+
+
+def test_seek_is_relative_to_start_offset():
+    buf = make(start_offset=30.0, prefill=10)
+    for _ in range(4):
+        buf.read()
+    assert not buf.seek(29.9)  # before the first decoded frame
+    assert buf.seek(30.02)
+    assert index_of(buf.read()) == 1
@@ -0,0 +1,24 @@
+import time
+
+import m4
+
+
+def test_expire_query_parameter():
+    assert m4.stream_expiry("https://rr1.googlevideo.com/videoplayback?id=1&expire=1700000000&ei=x") == 1700000000
+
+
+def test_expire_path_segment():
+    assert m4.stream_expiry("https://manifest.googlevideo.com/api/manifest/hls/expire/1700000123/ei/x") == 1700000123
+
+
+def test_fallback_ttl_without_expire():
+    before = time.time()
+    got = m4.stream_expiry("https://cdn.example.com/audio.webm?sig=abc")
+    assert before + m4.STREAM_URL_TTL <= got <= time.time() + m4.STREAM_URL_TTL
+    assert m4.stream_expiry(None) >= before + m4.STREAM_URL_TTL
+
+
+def test_expire_must_be_a_parameter_name():
+    # "nonexpire=" is not the expire parameter
+    before = time.time()
+    assert m4.stream_expiry("https://x/y?nonexpire=5") >= before + m4.STREAM_URL_TTL